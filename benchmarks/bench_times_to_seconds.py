@@ -0,0 +1,50 @@
+"""
+Compares `times_to_seconds` with the per-row `seconds_since_midnight`
+on random GTFS times, with hours over 24 and a share of null values.
+
+    python benchmarks/bench_times_to_seconds.py --rows 10000000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from gtfs_functions.aux_functions import MISSING_SECONDS, seconds_since_midnight, times_to_seconds
+
+
+def random_times(n_rows, null_share, seed=0):
+    rng = np.random.default_rng(seed)
+    seconds = rng.integers(0, 27 * 3600, n_rows)
+    times = pd.Series(
+        [f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}" for s in range(27 * 3600)], dtype=object
+    ).values[seconds]
+    times[rng.random(n_rows) < null_share] = None
+
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--null-share", type=float, default=0.02)
+    args = parser.parse_args()
+
+    times = random_times(args.rows, args.null_share)
+
+    start = time.perf_counter()
+    old = np.array([MISSING_SECONDS if t is None else seconds_since_midnight(t) for t in times])
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new = times_to_seconds(times)
+    new_time = time.perf_counter() - start
+
+    assert (old == new).all(), "times_to_seconds differs from seconds_since_midnight"
+    print(f"{args.rows:,} rows")
+    print(f"seconds_since_midnight: {old_time:.2f} s")
+    print(f"times_to_seconds:       {new_time:.2f} s ({old_time / new_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,17 +4,62 @@ import utm
 import geopandas as gpd
 import logging
 import numpy as np
+import shapely
+from haversine import haversine_vector, Unit
 
 
-def add_runtime(st):
-    # Get the runtime between stops
-    logging.info("adding runtime")
-    st.sort_values(by=["trip_id", "stop_sequence"], inplace=True, ascending=True)
-    c = st.trip_id == st.trip_id.shift(-1)
-    st.loc[c, "runtime_sec"] = st.arrival_time.shift(-1)[c] - st.arrival_time[c]
-    st["end_stop_id"] = st.stop_id.shift(-1)
+def trip_stops(stop_times):
+    """
+    Groups the stops of stop_times by trip without reordering the table.
+    Output:
+        - trip_index: integer code of the trip of each row.
+        - trip_ids: trip_id of each code.
+        - order: rows sorted by trip and stop_sequence. None when stop_times
+            is already in that order.
+        - offsets: the sorted rows of trip i are order[offsets[i]:offsets[i + 1]].
+    """
+    trip_index, trip_ids = pd.factorize(stop_times.trip_id)
+    stop_sequence = stop_times.stop_sequence.values
+
+    # Trips are numbered in order of appearance, so a table grouped by trip
+    # has non decreasing codes
+    trip_step = np.diff(trip_index)
+    grouped = np.all((trip_step > 0) | ((trip_step == 0) & (np.diff(stop_sequence) > 0)))
+    order = None if grouped else np.lexsort((stop_sequence, trip_index))
+
+    offsets = np.zeros(len(trip_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(trip_index, minlength=len(trip_ids)), out=offsets[1:])
+
+    return trip_index, trip_ids, order, offsets
+
+
+def add_segment_index(stop_times, trip_segment_patterns, pattern_segments):
+    """
+    Adds to each stop of stop_times the `segment_index` of the segment that
+    starts at that stop, looked up from the integer segment pattern of the
+    trip and the position of the stop in it. The last stop of each trip and
+    the trips without a segment pattern get NaN.
+    """
+    # Position of each stop in its trip
+    trip_index, trip_ids, order, offsets = trip_stops(stop_times)
+    rows = np.arange(len(stop_times)) if order is None else order
+    position = np.empty(len(rows), dtype=np.int64)
+    position[rows] = np.arange(len(rows)) - offsets[trip_index[rows]]
+
+    # First row and number of segments of each pattern in pattern_segments
+    pattern = trip_segment_patterns.set_index("trip_id").segment_pattern.reindex(trip_ids)
+    pattern = pattern.fillna(-1).values.astype(np.int64)[trip_index]
+    n_patterns = trip_segment_patterns.segment_pattern.max() + 1
+    n_segments = np.bincount(pattern_segments.segment_pattern.values, minlength=n_patterns)
+    first_segment = np.cumsum(n_segments) - n_segments
+
+    has_segment = (pattern >= 0) & (position < n_segments[pattern])
+    segment_index = np.full(len(position), np.nan)
+    segment_index[has_segment] = pattern_segments.segment_index.values[
+        first_segment[pattern[has_segment]] + position[has_segment]
+    ]
 
-    return st
+    return stop_times.assign(segment_index=segment_index)
 
 
 def add_distance(
@@ -23,6 +68,7 @@ def add_distance(
     seg_cols=[
         "shape_id",
         "route_id",
+        "route_name",
         "direction_id",
         "stop_sequence",
         "segment_id",
@@ -35,25 +81,20 @@ def add_distance(
         "geometry",
     ],
     st_cols=[
-        "shape_id",
-        "route_id",
-        "route_name",
-        "direction_id",
-        "stop_sequence",
-        "stop_id",
-        "end_stop_id",
+        "segment_index",
         "runtime_sec",
         "arrival_time",
         "departure_time",
     ],
 ):
     logging.info("adding distance in meters")
-    st = stop_times[st_cols]
-    st.rename(columns={"stop_id": "start_stop_id"}, inplace=True)
+    st = stop_times.loc[stop_times.segment_index.notnull(), st_cols]
+    st["segment_index"] = st.segment_index.astype(int)
 
-    # Merge with segments_gdf to get the distance
-    dist = pd.merge(st, segments_gdf[seg_cols], how="left")
-    dist = gpd.GeoDataFrame(data=dist, geometry=dist.geometry, crs="EPSG:4326")
+    # Merge with segments_gdf to get the distance. There is one segment
+    # per segment_index, so the rows keep the index of stop_times
+    dist = pd.merge(st, segments_gdf[seg_cols].reset_index(names="segment_index"), how="left")
+    dist = gpd.GeoDataFrame(data=dist, geometry=dist.geometry, crs="EPSG:4326").set_axis(st.index)
 
     return dist
 
@@ -249,7 +290,7 @@ def add_all_lines(line_frequencies, segments_gdf, labels, cutoffs):
     logging.info("adding data for all lines.")
 
     # Calculate sum of trips per segment with all lines
-    all_lines = line_frequencies.pivot_table(["ntrips"], index=["segment_id", "window"], aggfunc="sum").reset_index()
+    all_lines = line_frequencies.groupby(["segment_id", "window"], observed=True).ntrips.sum().reset_index()
 
     sort_these = ["direction_id", "window", "stop_sequence"]
 
@@ -271,10 +312,8 @@ def add_all_lines(line_frequencies, segments_gdf, labels, cutoffs):
     data_all_lines["direction_id"] = "NA"
 
     # Add frequency for all lines
-    start_time = data_all_lines.window.apply(lambda x: cutoffs[labels.index(x)])
-    end_time = data_all_lines.window.apply(lambda x: cutoffs[labels.index(x) + 1])
-
-    data_all_lines["min_per_trip"] = ((end_time - start_time) * 60 / data_all_lines.ntrips).astype(int)
+    minutes = window_minutes(data_all_lines.window, labels, cutoffs)
+    data_all_lines["min_per_trip"] = (minutes / data_all_lines.ntrips.values).astype(int)
 
     # Append data for all lines to the input df
     data_complete = pd.concat([line_frequencies, data_all_lines]).reset_index(drop=True)
@@ -341,28 +380,42 @@ def label_creation(cutoffs):
     return labels
 
 
-def window_creation(stop_times, cutoffs):
-    "Adds the time time window and labels to stop_times"
-
+def window_codes(seconds, cutoffs):
+    """
+    Index of the time window of each time, -1 for times outside all the
+    windows. Windows include their start and exclude their end.
+    Input:
+        - seconds: np.array with seconds since midnight, NaN if missing.
+        - cutoffs: list of hours where the windows start and end.
+    """
     # If the cutoffs are withing 0 and 24 hours, let's make sure
     # the times of the GTFS fit this time period
     if max(cutoffs) <= 24:
-        stop_times["departure_time"] = fix_departure_time(stop_times.departure_time.values)
-        stop_times["arrival_time"] = fix_departure_time(stop_times.arrival_time.values)
+        seconds = fix_departure_time(np.array(seconds, dtype=float))
+
+    hours = seconds / 3600
+    codes = np.searchsorted(np.asarray(cutoffs, dtype=float), hours, side="right") - 1
+    codes[(codes >= len(cutoffs) - 1) | np.isnan(hours)] = -1
+
+    return codes.astype(np.int16)
 
-    # Create the labels for the cutoffs
-    labels = label_creation(cutoffs)
 
-    # Get departure time as hour and a fraction
-    departure_time = stop_times.departure_time / 3600
+def add_window(df, codes, labels):
+    """
+    Returns the rows of df with a time window (codes >= 0) and their
+    window label in a new "window" column. df is not modified.
+    """
+    keep = codes >= 0
+    window = np.asarray(labels, dtype=object)[codes[keep]]
 
-    # Put each trip in the right window
-    stop_times["window"] = pd.cut(departure_time, bins=cutoffs, right=False, labels=labels)
-    stop_times = stop_times.loc[~stop_times.window.isnull()]
+    return df.loc[keep].assign(window=window)
 
-    stop_times["window"] = stop_times.window.astype(str)
 
-    return stop_times
+def window_creation(stop_times, cutoffs):
+    "Adds the time window labels to a copy of stop_times"
+    codes = window_codes(stop_times.departure_time.values, cutoffs)
+
+    return add_window(stop_times, codes, label_creation(cutoffs))
 
 
 def seconds_since_midnight(times_string):
@@ -380,34 +433,497 @@ def seconds_since_midnight(times_string):
     return seconds
 
 
-def add_frequency(
-    stop_times,
-    labels,
-    index_="stop_id",
-    col="window",
-    cutoffs=[0, 6, 9, 15, 19, 22, 24],
-):
+# Value used for missing or invalid times in arrays of seconds since midnight
+MISSING_SECONDS = -1
+
+
+def times_to_seconds(times):
+    """
+    Vectorized version of `seconds_since_midnight`. Transforms an array
+    of time strings of the form "10:00:10" (hours can be over 24) to int32
+    seconds since midnight. Blank, null or invalid times are set to
+    MISSING_SECONDS.
+
+    Departure times repeat a lot, so only the unique strings are parsed.
+    """
+    if isinstance(times, pd.Series) and isinstance(times.dtype, pd.CategoricalDtype):
+        codes, uniques = times.cat.codes.values, times.cat.categories
+    else:
+        codes, uniques = pd.factorize(np.asarray(times, dtype=object))
+
+    parts = pd.Series(uniques, dtype=object).str.extract(r"^\s*(\d+):(\d+):(\d+)\s*$").astype(float)
+    seconds = (parts[0] * 3600 + parts[1] * 60 + parts[2]).fillna(MISSING_SECONDS).values.astype(np.int32)
+
+    # Code -1 means the value was null
+    seconds = np.append(seconds, np.int32(MISSING_SECONDS))
+
+    return seconds[codes]
+
+
+def window_minutes(windows, labels, cutoffs):
+    """
+    Length in minutes of the time window of each label in windows,
+    looked up once for each distinct label.
+    """
+    first = {}
+    for i, label in enumerate(labels):
+        first.setdefault(label, i)
+
+    minutes = np.diff(np.asarray(cutoffs, dtype=float)) * 60
+    codes, uniques = pd.factorize(np.asarray(windows))
+
+    return minutes[[first[window] for window in uniques]][codes]
+
+
+def group_codes(df, index_list, sort=False):
+    """
+    Integer code of the group of each row of df by the columns in index_list.
+    Output:
+        - group: code of each row, -1 if one of its keys is missing.
+        - groups: DataFrame with the index columns of each group, row i is group i.
+    """
+    group = df.groupby(index_list, sort=sort, observed=True).ngroup().fillna(-1).values.astype(np.int64)
+    codes, first = np.unique(group, return_index=True)
+    groups = df[index_list].iloc[first[codes >= 0]].reset_index(drop=True)
+
+    return group, groups
+
+
+def window_schemes(time_windows, default):
+    """
+    Normalizes the time_windows argument of the frequency outputs.
+    Returns the list of cutoffs of each scheme and whether several
+    schemes were asked for, e.g. [[0, 6, 9, 24], list(range(25))].
+    """
+    if time_windows is None:
+        return [default], False
+    if np.ndim(time_windows[0]) > 0:
+        return [list(cutoffs) for cutoffs in time_windows], True
+
+    return [list(time_windows)], False
+
+
+def window_frequency(groups, group, window, cutoffs):
+    """
+    Number of trips and minutes per trip of each group by time window.
+    Input:
+        - groups, group: groups and group of each departure from `group_codes`.
+        - window: time window code of each departure, -1 outside the windows.
+        - cutoffs: list of hours where the windows start and end.
+    Output:
+        - DataFrame with the columns of groups, window, ntrips and min_per_trip.
+    """
+    labels = np.asarray(label_creation(cutoffs), dtype=object)
+    n_windows = len(cutoffs) - 1
+
+    keep = (group >= 0) & (window >= 0)
+    counts = np.bincount(group[keep] * n_windows + window[keep], minlength=len(groups) * n_windows)
+    pairs = np.flatnonzero(counts)
+    ntrips = counts[pairs]
+
+    trips_agg = groups.iloc[pairs // n_windows].reset_index(drop=True)
+    window = pairs % n_windows
+    trips_agg["window"] = labels[window]
+    trips_agg["ntrips"] = ntrips
+
+    duration = np.diff(np.asarray(cutoffs, dtype=float))[window]
+    trips_agg["min_per_trip"] = (duration * 60 / ntrips).astype(int)
+
+    return trips_agg.sort_values(list(groups.columns) + ["window"]).reset_index(drop=True)
+
+
+def headway_stats(group, seconds, window, n_windows):
+    """
+    Gaps between consecutive departures of the same group and their
+    statistics by time window. Departures are sorted once by group and
+    time, and each gap belongs to the window of the departure that ends it.
+    Input:
+        - group: integer group of each departure, -1 to leave it out.
+        - seconds: departure time in seconds, NaN if missing.
+        - window: time window code of each departure, -1 outside the windows.
+        - n_windows: number of time windows.
+    Output:
+        - DataFrame with group, window, n_headways and the mean, median,
+            max, p90 and coefficient of variation (cv) of the gaps in seconds.
+    """
+    valid = (group >= 0) & ~np.isnan(seconds)
+    group, seconds, window = group[valid], seconds[valid], window[valid]
+    order = np.lexsort((seconds, group))
+    group, seconds, window = group[order], seconds[order], window[order]
+
+    same_group = (group[1:] == group[:-1]) & (window[1:] >= 0)
+    gaps = np.diff(seconds)[same_group]
+    key = group[1:][same_group] * n_windows + window[1:][same_group]
+
+    # Gaps sorted within each (group, window) for the quantiles
+    order = np.lexsort((gaps, key))
+    gaps, key = gaps[order], key[order]
+    keys, start, counts = np.unique(key, return_index=True, return_counts=True)
+
+    def quantile(q):
+        position = start + q * (counts - 1)
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        return gaps[low] + (gaps[high] - gaps[low]) * (position - low)
+
+    if len(keys) > 0:
+        mean = np.add.reduceat(gaps, start) / counts
+        variance = np.maximum(np.add.reduceat(gaps**2, start) / counts - mean**2, 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            cv = np.where(mean > 0, np.sqrt(variance) / mean, np.nan)
+        maximum = gaps[start + counts - 1]
+    else:
+        mean = variance = cv = maximum = np.array([], dtype=float)
+
+    return pd.DataFrame(
+        {
+            "group": keys // n_windows,
+            "window": keys % n_windows,
+            "n_headways": counts,
+            "mean": mean,
+            "median": quantile(0.5),
+            "max": maximum,
+            "p90": quantile(0.9),
+            "cv": cv,
+        }
+    )
+
+
+# Columns holding GTFS identifiers and the ID dictionary that codes them
+ID_COLUMNS = {
+    "trip_id": "trip_id",
+    "stop_id": "stop_id",
+    "start_stop_id": "stop_id",
+    "end_stop_id": "stop_id",
+    "route_id": "route_id",
+    "shape_id": "shape_id",
+}
+
+
+def encode_ids(df, ids):
+    """
+    Replaces the identifier columns of df (see ID_COLUMNS) by categoricals
+    whose categories are the feed's ID dictionary, so that merges, groupbys
+    and pivots between tables work on their integer codes.
+    Input:
+        - df: DataFrame with some identifier columns.
+        - ids: dictionary of key: pd.Index with the identifiers already coded.
+            Identifiers that are not in it yet are appended.
+    Output:
+        - copy of df with the identifier columns coded.
+    """
+    df = df.copy()
+    for col, key in ID_COLUMNS.items():
+        if col not in df.columns:
+            continue
+
+        values = df[col].astype("category")
+        categories = values.cat.categories.astype(str)
+
+        dictionary = ids.get(key, pd.Index([], dtype=object))
+        new_ids = categories[dictionary.get_indexer(categories) == -1]
+        if len(new_ids) > 0:
+            dictionary = dictionary.append(new_ids)
+            ids[key] = dictionary
+
+        # Code -1 means the value was null
+        mapping = np.append(dictionary.get_indexer(categories), -1)
+        df[col] = pd.Categorical.from_codes(mapping[values.cat.codes.values], dtype=pd.CategoricalDtype(dictionary))
+
+    return df
+
+
+def decode_ids(df):
+    """
+    Turns the coded identifier columns of df back to their original strings.
+    """
+    df = df.copy()
+    for col in ID_COLUMNS:
+        if col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+
+    return df
+
+
+def gtfs_dates(dates):
+    """
+    Parses GTFS dates of the form "20230131" (as strings or integers)
+    into a numpy array of datetime64[D].
+    """
+    return pd.to_datetime(pd.Series(dates).astype(str), format="%Y%m%d").values.astype("datetime64[D]")
+
+
+def service_bitmap(calendar, calendar_dates):
+    """
+    Expands calendar and calendar_dates into a boolean matrix with one row
+    per service_id and one column per date of the feed, True when the
+    service runs on that date. Additions (exception_type=1) and removals
+    (exception_type=2) of calendar_dates are applied over the calendar.
+
+    Returns (service_ids, dates, bitmap) where dates is a datetime64[D] array.
+    """
+    tables = [t for t in [calendar, calendar_dates] if t is not None]
+    service_ids = pd.Index(pd.concat([t.service_id for t in tables], ignore_index=True).unique(), name="service_id")
+
+    bounds = []
+    if calendar is not None:
+        start = gtfs_dates(calendar.start_date)
+        end = gtfs_dates(calendar.end_date)
+        bounds += [start, end]
+    if calendar_dates is not None:
+        exception_dates = gtfs_dates(calendar_dates.date)
+        bounds += [exception_dates]
+
+    bounds = np.concatenate(bounds)
+    if len(bounds) == 0:
+        return service_ids, np.array([], dtype="datetime64[D]"), np.zeros((len(service_ids), 0), dtype=bool)
+
+    dates = np.arange(bounds.min(), bounds.max() + 1, dtype="datetime64[D]")
+    bitmap = np.zeros((len(service_ids), len(dates)), dtype=bool)
+
+    if calendar is not None:
+        # 1970-01-01 was a Thursday, so this gives Monday=0, ..., Sunday=6
+        weekday = (dates.astype(np.int64) + 3) % 7
+        days = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+        runs_on_weekday = calendar[days].values.astype(bool)[:, weekday]
+        in_range = (dates[None, :] >= start[:, None]) & (dates[None, :] <= end[:, None])
+
+        # A service_id could be defined in more than one row
+        np.logical_or.at(bitmap, service_ids.get_indexer(calendar.service_id), runs_on_weekday & in_range)
+
+    if calendar_dates is not None:
+        rows = service_ids.get_indexer(calendar_dates.service_id)
+        cols = (exception_dates - dates[0]).astype(np.int64)
+        added = (calendar_dates.exception_type == 1).values
+        removed = (calendar_dates.exception_type == 2).values
+
+        bitmap[rows[added], cols[added]] = True
+        bitmap[rows[removed], cols[removed]] = False
+
+    return service_ids, dates, bitmap
+
+
+def shape_lines(shape_points):
+    """
+    Builds a LineString for each shape_id from the points in shapes.txt.
+    Returns a GeoDataFrame with the columns shape_id and geometry.
+    """
+    points = shape_points.sort_values(["shape_id", "shape_pt_sequence"])
+    shape_index, shape_ids = pd.factorize(points.shape_id)
+
+    lines = shapely.linestrings(points[["shape_pt_lon", "shape_pt_lat"]].values, indices=shape_index)
+
+    return gpd.GeoDataFrame(data={"shape_id": shape_ids}, geometry=lines, crs=4326)
+
+
+def vertex_distances(lines):
+    """
+    Normalized distance along each line of every one of its vertices,
+    from the cumulative length of its coordinate differences.
+    Input:
+        - lines: array of LineStrings.
+    Output:
+        - coords: (n, 2) array with the vertices of all the lines.
+        - offsets: the vertices of line i are coords[offsets[i]:offsets[i + 1]].
+        - distances: normalized distance along its line of each vertex.
+    """
+    coords, line_index = shapely.get_coordinates(lines, return_index=True)
+    offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(line_index, minlength=len(lines)), out=offsets[1:])
 
-    if isinstance(index_, list):
-        index_list = index_ + ["direction_id", col]
-    elif isinstance(index_, str):
-        index_list = [index_, "direction_id", col]
+    step = np.zeros(len(coords))
+    step[1:] = np.hypot(*np.diff(coords, axis=0).T)
+    # The first vertex of each line starts at 0
+    step[offsets[:-1][offsets[:-1] < len(coords)]] = 0
+    cumulative = np.cumsum(step)
 
-    # Some gtfs feeds only contain direction_id 0, use that as default
-    trips_agg = stop_times.pivot_table("trip_id", index=index_list, aggfunc="count").reset_index()
+    line_start = cumulative[offsets[:-1][line_index]]
+    line_length = cumulative[offsets[1:][line_index] - 1] - line_start
+    with np.errstate(invalid="ignore", divide="ignore"):
+        distances = np.where(line_length > 0, (cumulative - line_start) / line_length, 0)
 
-    # direction_id is optional, as it is not needed to determine trip frequencies
-    # However, if direction_id is NaN, pivot_table will return an empty DataFrame.
-    # Therefore, use a sensible default if direction id is not known.
-    # Some gtfs feeds only contain direction_id 0, use that as default
-    trips_agg.rename(columns={"trip_id": "ntrips"}, inplace=True)
+    return coords, offsets, distances
 
-    start_time = trips_agg.window.apply(lambda x: cutoffs[labels.index(x)])
-    end_time = trips_agg.window.apply(lambda x: cutoffs[labels.index(x) + 1])
 
-    trips_agg["min_per_trip"] = ((end_time - start_time) * 60 / trips_agg.ntrips).astype(int)
+def cut_lines(coords, offsets, distances, line, start_cut, end_cut, start_points, end_points, tolerance=1e-9):
+    """
+    Cuts pieces of lines between two normalized distances along them.
+    Input:
+        - coords, offsets, distances: vertices of the lines as returned
+            by vertex_distances.
+        - line: index of the line each piece is cut from.
+        - start_cut, end_cut: normalized distance where each piece starts and ends.
+        - start_points, end_points: (n, 2) arrays with the first and last
+            point of each piece.
+        - tolerance: vertices closer than this to a cut are dropped, as the
+            cut point already stands for them.
+    Output:
+        - piece_coords: (m, 2) array with the vertices of all the pieces.
+        - piece: index of the piece of each vertex, ready for shapely.linestrings.
+    """
+    # Every line is spread over its own interval [2 * i, 2 * i + 1] so
+    # the vertices of all the lines can be searched at once
+    line_index = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    keys = 2 * line_index + distances
+    first = np.searchsorted(keys, 2 * line + start_cut + tolerance, side="right")
+    last = np.searchsorted(keys, 2 * line + end_cut - tolerance, side="left")
+    last = np.maximum(first, last)
+
+    # Each piece is its start point, the vertices in between and its end point
+    n_points = last - first + 2
+    piece = np.repeat(np.arange(len(n_points)), n_points)
+    position = np.arange(len(piece)) - np.repeat(np.cumsum(n_points) - n_points, n_points)
+
+    piece_coords = coords[np.minimum(first[piece] + position - 1, len(coords) - 1)]
+    piece_coords[position == 0] = start_points
+    piece_coords[position == n_points[piece] - 1] = end_points
+
+    return piece_coords, piece
+
+
+def segment_coords(line_coords, line_offsets, stop_line, stop_points, start_stop, end_stop):
+    """
+    Cuts lines into stop to stop segments. Only takes and returns plain
+    arrays so it can run in a worker process.
+    Input:
+        - line_coords, line_offsets: vertices of the lines, the vertices
+            of line i are line_coords[line_offsets[i]:line_offsets[i + 1]].
+        - stop_line, stop_points: line and (n, 2) coordinates of each stop
+            to project onto that line.
+        - start_stop, end_stop: index in stop_points of the first and last
+            stop of each segment.
+    Output:
+        - coords: (m, 2) array with the vertices of all the segments.
+        - segment: index of the segment of each vertex.
+    """
+    line_index = np.repeat(np.arange(len(line_offsets) - 1), np.diff(line_offsets))
+    lines = shapely.linestrings(line_coords, indices=line_index)
+
+    # Project each stop onto its line
+    stop_lines = lines[stop_line]
+    cut = shapely.line_locate_point(stop_lines, shapely.points(stop_points), normalized=True)
+    projected = shapely.get_coordinates(shapely.line_interpolate_point(stop_lines, cut, normalized=True))
+
+    coords, offsets, distances = vertex_distances(lines)
+
+    return cut_lines(
+        coords,
+        offsets,
+        distances,
+        stop_line[start_stop],
+        cut[start_stop],
+        cut[end_stop],
+        projected[start_stop],
+        projected[end_stop],
+    )
+
+
+def balanced_chunks(weights, n_chunks):
+    """
+    Splits a sequence of items into at most n_chunks contiguous chunks
+    with a similar total weight. Returns the index of the first item of
+    each chunk followed by the number of items.
+    """
+    if len(weights) == 0:
+        return np.zeros(1, dtype=np.int64)
+
+    cumulative = np.cumsum(weights)
+    targets = cumulative[-1] * np.arange(1, n_chunks) / n_chunks
+    bounds = np.searchsorted(cumulative, targets, side="right")
+
+    return np.unique(np.concatenate([[0], bounds, [len(weights)]]))
+
 
-    return trips_agg
+def haversine_m(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in meters between arrays of points.
+    """
+    if np.size(lat1) == 0:
+        return np.zeros(0)
+
+    return haversine_vector(np.column_stack([lat1, lon1]), np.column_stack([lat2, lon2]), Unit.METERS)
+
+
+def line_lengths_m(lines):
+    """
+    Length in meters of each LineString of an array, as the sum of the
+    great-circle distances between its consecutive points. Works for lines
+    anywhere on the globe without reprojecting them.
+    """
+    coords, line_index = shapely.get_coordinates(lines, return_index=True)
+    same_line = line_index[1:] == line_index[:-1]
+    steps = haversine_m(coords[:-1, 1], coords[:-1, 0], coords[1:, 1], coords[1:, 0])
+
+    return np.bincount(line_index[1:][same_line], weights=steps[same_line], minlength=len(lines))
+
+
+def shape_lengths_km(shapes):
+    """
+    Length in km of each shape of a GeoDataFrame of LineStrings.
+    """
+    return line_lengths_m(shapes.geometry.values) / 1000
+
+
+# Bases of the polynomial fingerprints of the sequences in sequence_codes
+SEQUENCE_HASH_BASES = [0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F]
+
+
+def sequence_codes(groups, values):
+    """
+    Identifies the groups (e.g. trips) that have exactly the same sequence
+    of values (e.g. stops). The rows of each group are taken in the order
+    they appear.
+    Input:
+        - groups: array with the group of each row.
+        - values: integer array with the value of each row.
+    Output:
+        - keys: unique groups in order of appearance.
+        - codes: integer code of the sequence of each group. Groups with
+            the same code have identical sequences.
+        - order: row indices sorted by group, keeping their original order.
+        - offsets: the rows of group i are order[offsets[i]:offsets[i + 1]].
+    """
+    group_index, keys = pd.factorize(groups)
+    values = np.asarray(values, dtype=np.int64)
+
+    order = np.argsort(group_index, kind="stable")
+    counts = np.bincount(group_index, minlength=len(keys))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    if len(keys) == 0:
+        return keys, np.array([], dtype=np.int64), order, offsets
+
+    sorted_values = values[order]
+    sorted_groups = group_index[order]
+    position = np.arange(len(order)) - offsets[sorted_groups]
+
+    # Two polynomial fingerprints of each sequence (modulo 2**64)
+    fingerprints = {"count": counts}
+    for i, base in enumerate(SEQUENCE_HASH_BASES):
+        powers = np.cumprod(np.full(counts.max(), base, dtype=np.uint64))
+        terms = (sorted_values.astype(np.uint64) + np.uint64(1)) * powers[position]
+        fingerprints[i] = np.add.reduceat(terms, offsets[:-1])
+
+    codes = pd.DataFrame(fingerprints).groupby(list(fingerprints), sort=False).ngroup().values
+
+    # Compare every sequence with the first one that got the same code
+    # to resolve fingerprint collisions exactly
+    _, first_group = np.unique(codes, return_index=True)
+    rep_rows = offsets[first_group[codes][sorted_groups]] + position
+    mismatch = sorted_values != sorted_values[rep_rows]
+
+    if mismatch.any():
+        collided = np.unique(sorted_groups[mismatch])
+        new_codes = {}
+        next_code = codes.max() + 1
+        for g in collided:
+            sequence = tuple(sorted_values[offsets[g] : offsets[g + 1]])
+            if sequence not in new_codes:
+                new_codes[sequence] = next_code + len(new_codes)
+            codes[g] = new_codes[sequence]
+
+    return keys, codes, order, offsets
 
 
 def add_route_name(data, routes):
@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+
+from gtfs_functions.aux_functions import MISSING_SECONDS, times_to_seconds
+
+
+def _seconds(times):
+    """
+    Seconds since midnight from numbers or "HH:MM:SS" strings.
+    Missing or invalid times are MISSING_SECONDS.
+    """
+    times = np.atleast_1d(times)
+    if times.dtype.kind in "OUS":
+        return times_to_seconds(pd.Series(times)).astype(np.int64)
+
+    times = times.astype(float)
+    return np.where(np.isnan(times), MISSING_SECONDS, times).astype(np.int64)
+
+
+class DepartureIndex:
+    """
+    Departures of every stop sorted by time, for "next departures" queries.
+
+    The departures of stop i are at positions offsets[i]:offsets[i + 1] of
+    the departure, trip and route arrays (CSR layout), sorted by departure
+    time. Stops, trips and routes are integer codes whose labels are in
+    stop_ids, trip_ids and route_ids. A query is a binary search within the
+    departures of its stop.
+    """
+
+    def __init__(self, stop_ids, trip_ids, route_ids, offsets, departure, trip, route):
+        self.stop_ids = pd.Index(np.asarray(stop_ids))
+        self.trip_ids = pd.Index(np.asarray(trip_ids))
+        self.route_ids = pd.Index(np.asarray(route_ids))
+        self.offsets = offsets
+        self.departure = departure
+        self.trip = trip
+        self.route = route
+
+        # Departures of all the stops one after the other in a single
+        # sorted array of (stop, departure) keys
+        stop = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+        self._keys = (stop << 32) | departure.astype(np.int64)
+
+    @classmethod
+    def from_trip_table(cls, table):
+        trip = table.trip_index()
+        has_time = table.departure != MISSING_SECONDS
+        stop, departure, trip = table.stop[has_time], table.departure[has_time], trip[has_time]
+
+        order = np.lexsort((departure, stop))
+        offsets = np.zeros(len(table.stop_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(stop, minlength=len(table.stop_ids)), out=offsets[1:])
+
+        return cls(
+            stop_ids=table.stop_ids,
+            trip_ids=table.trip_ids,
+            route_ids=table.route_ids,
+            offsets=offsets,
+            departure=departure[order].astype(np.int32),
+            trip=trip[order].astype(np.int32),
+            route=table.route_code[trip[order]],
+        )
+
+    def next_departures(self, stop_ids, times, n=5):
+        """
+        Next n departures at or after each (stop, time) query. Several queries
+        are answered at once when stop_ids and/or times are arrays.
+        Unknown stops and missing, invalid or negative times get no rows.
+        Input:
+            - stop_ids: stop_id or array of stop_ids.
+            - times: seconds since midnight or "HH:MM:SS", or an array of them.
+            - n: maximum number of departures per query.
+        Output:
+            - DataFrame with query (position of the query), stop_id, trip_id,
+                route_id and departure_time in seconds, sorted by query and time.
+        """
+        stop_ids, seconds = np.broadcast_arrays(np.atleast_1d(stop_ids), _seconds(times))
+        stop = self.stop_ids.get_indexer(stop_ids).astype(np.int64)
+
+        # Unknown stops and missing times have no departures
+        valid = (stop >= 0) & (seconds >= 0)
+        first = np.zeros(len(stop), dtype=np.int64)
+        last = np.zeros(len(stop), dtype=np.int64)
+        first[valid] = np.searchsorted(self._keys, (stop[valid] << 32) | seconds[valid], side="left")
+        last[valid] = self.offsets[stop[valid] + 1]
+
+        # The search never leaves the departures of the stop
+        first[valid] = np.maximum(first[valid], self.offsets[stop[valid]])
+
+        counts = np.clip(last - first, 0, n)
+        query = np.repeat(np.arange(len(stop)), counts)
+        positions = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        return pd.DataFrame(
+            {
+                "query": query,
+                "stop_id": self.stop_ids[stop[query]],
+                "trip_id": self.trip_ids[self.trip[positions]],
+                "route_id": self.route_ids[self.route[positions]],
+                "departure_time": self.departure[positions],
+            }
+        )
+
+    def save(self, path):
+        """
+        Store the index in a .npz file that `DepartureIndex.load()` can read.
+        """
+        np.savez_compressed(
+            path,
+            stop_ids=np.asarray(self.stop_ids, dtype=str),
+            trip_ids=np.asarray(self.trip_ids, dtype=str),
+            route_ids=np.asarray(self.route_ids, dtype=str),
+            offsets=self.offsets,
+            departure=self.departure,
+            trip=self.trip,
+            route=self.route,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(**{name: data[name] for name in data.files})
@@ -0,0 +1,262 @@
+import functools
+import hashlib
+import io
+import logging
+import os
+import tempfile
+from zipfile import ZipFile
+
+import boto3
+import numpy as np
+import pandas as pd
+import requests
+from pandas.api.types import union_categoricals
+
+
+class DownloadCache:
+    """
+    On-disk cache of remote GTFS archives shared across Feed instances
+    and processes.
+
+    Entries are keyed by the source URL plus the version reported by the
+    server (S3 VersionId or ETag, HTTP ETag or Last-Modified), so a feed is
+    downloaded again only when it changes. When the cache grows over
+    `max_size_mb` the least recently used archives are evicted.
+    """
+
+    def __init__(self, cache_dir: str, max_size_mb: int = 2048):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size = max_size_mb * 1024**2
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path(self, url, version):
+        key = hashlib.sha256(f"{url}\n{version}".encode("UTF-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.zip")
+
+    def get(self, url, version):
+        """
+        Returns the cached archive opened in binary mode, or None if
+        this version of the feed is not in the cache.
+        """
+        path = self.path(url, version)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+
+        # Touch the entry so it counts as recently used. Another process
+        # may have evicted it since, but the open file is still readable
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        logging.info(f'Reading "{url}" from the download cache.')
+        return f
+
+    def put(self, url, download):
+        """
+        Store a new version of a feed. `download` is called with a
+        binary file object, must write the archive to it and return the
+        version of the feed it wrote, which becomes the key of the entry.
+        Returns the cached archive opened in binary mode.
+        """
+        # Write to a temporary file first so that other processes never
+        # see a partially downloaded archive
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                version = download(f)
+            path = self.path(url, version)
+
+            # Open before publishing it, so the file stays readable even if
+            # another process evicts the entry right away
+            f = open(tmp_path, "rb")
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self.evict(keep=path)
+        return f
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".zip"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+
+        # Remove the least recently used entries first
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                continue
+
+
+class GTFSArchive:
+    """
+    Read-only handle over a zipped GTFS feed.
+
+    The zip file is opened once and every member is streamed straight
+    into the CSV parser, so nothing is extracted to disk. Remote feeds
+    (S3 or URL) are downloaded once and kept in memory until the archive
+    is closed, or stored in a `DownloadCache` if one is given.
+    """
+
+    def __init__(self, gtfs_path: str, cache: DownloadCache = None):
+        self._gtfs_path = gtfs_path
+        self._cache = cache
+        self._file = None
+        self._zip = None
+
+    @property
+    def gtfs_path(self):
+        return self._gtfs_path
+
+    @property
+    def zip(self):
+        if self._zip is None:
+            self._zip = self.open_zip()
+
+        return self._zip
+
+    def open_zip(self):
+        gtfs_path = self.gtfs_path
+
+        # S3 implementation
+        if gtfs_path.split("://")[0] == "s3":
+            s3 = boto3.resource("s3")
+            bucket = gtfs_path.split("://")[1].split("/")[0]
+            boto_bucket = s3.Bucket(bucket)
+            key = "/".join(gtfs_path.split("/")[3:])
+
+            if self._cache is not None:
+                obj = s3.Object(bucket, key)
+                obj.load()
+                version = obj.version_id or obj.e_tag
+                download = functools.partial(self.download_s3, boto_bucket, key, obj.version_id, obj.e_tag)
+                return ZipFile(self.cached(version, download))
+
+            data = io.BytesIO()
+            boto_bucket.download_fileobj(key, data)
+            return ZipFile(data)
+        else:
+            try:
+                return ZipFile(gtfs_path)
+            # Try as a URL if the file is not in local
+            except (FileNotFoundError, OSError) as e:
+                logging.error(e)
+
+            if self._cache is not None:
+                head = requests.head(gtfs_path, allow_redirects=True)
+                version = head.headers.get("ETag") or head.headers.get("Last-Modified")
+
+                # Without a version we can't tell if the cached copy is stale
+                if head.ok and version is not None:
+                    download = functools.partial(self.download_url, default_version=version)
+                    return ZipFile(self.cached(version, download))
+
+            r = requests.get(gtfs_path)
+            return ZipFile(io.BytesIO(r.content))
+
+    def cached(self, version, download):
+        f = self._cache.get(self.gtfs_path, version)
+        if f is None:
+            logging.info(f'Downloading "{self.gtfs_path}" to the download cache.')
+            f = self._cache.put(self.gtfs_path, download)
+
+        # ZipFile doesn't close file objects it didn't open
+        self._file = f
+        return f
+
+    @staticmethod
+    def download_s3(boto_bucket, key, version_id, e_tag, f):
+        """
+        Download the version of the object that was looked up, so an object
+        replaced in the meantime is not cached under the old version.
+        """
+        if version_id is not None:
+            extra_args = {"VersionId": version_id}
+        else:
+            extra_args = {"IfMatch": e_tag}
+        boto_bucket.download_fileobj(key, f, ExtraArgs=extra_args)
+
+        return version_id or e_tag
+
+    def download_url(self, f, default_version=None):
+        """
+        Download the feed and return the version sent with it, which can be
+        newer than the one the HEAD request reported. `default_version` is
+        returned if the response has no version headers.
+        """
+        with requests.get(self.gtfs_path, stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=1024**2):
+                f.write(chunk)
+
+            return r.headers.get("ETag") or r.headers.get("Last-Modified") or default_version
+
+    def namelist(self):
+        return self.zip.namelist()
+
+    def read_csv(self, member, **kwargs):
+        """
+        Parse a member of the archive with `pd.read_csv` reading
+        directly from the compressed stream.
+        """
+        with self.zip.open(member) as f:
+            return pd.read_csv(f, **kwargs)
+
+    def read_csv_filtered(self, member, filters, chunksize=1_000_000, **kwargs):
+        """
+        Parse a member of the archive chunk by chunk, keeping only the rows
+        whose columns take one of the values in `filters`, a dictionary
+        of column: allowed values. Peak memory scales with the rows kept
+        instead of the whole file.
+        """
+        filters = {col: pd.Index(values).unique() for col, values in filters.items()}
+        chunks = []
+        with self.zip.open(member) as f:
+            for chunk in pd.read_csv(f, chunksize=chunksize, **kwargs):
+                keep = np.ones(len(chunk), dtype=bool)
+                for col, values in filters.items():
+                    keep &= chunk[col].isin(values).values
+                chunks.append(chunk[keep])
+
+        # Chunks have different categories, which pd.concat would turn
+        # into object columns, so categorical columns are joined on their own
+        categorical = [c for c in chunks[0].columns if isinstance(chunks[0][c].dtype, pd.CategoricalDtype)]
+        data = pd.concat([chunk.drop(columns=categorical) for chunk in chunks], ignore_index=True)
+        for col in categorical:
+            data[col] = union_categoricals([chunk[col] for chunk in chunks])
+
+        return data[chunks[0].columns]
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,37 +1,52 @@
 import numpy as np
 import pandas as pd
-from zipfile import ZipFile
-import os
 import logging
 import geopandas as gpd
-import requests
-import io
 import pendulum as pl
 import hashlib
-from shapely.geometry import LineString, MultiPoint
+import shapely
+from gtfs_functions.gtfs_archive import GTFSArchive, DownloadCache
+from gtfs_functions.trip_table import TripTable
+from gtfs_functions.departure_index import DepartureIndex
+from gtfs_functions.trip_intervals import TripIntervals
 from gtfs_functions.aux_functions import (
     add_all_lines,
-    add_runtime,
     add_distance,
+    add_segment_index,
     add_speed,
-    code,
     fix_outliers,
     num_to_letters,
     add_route_name,
-    seconds_since_midnight,
-    window_creation,
+    times_to_seconds,
+    MISSING_SECONDS,
+    service_bitmap,
+    shape_lines,
+    shape_lengths_km,
+    line_lengths_m,
+    haversine_m,
+    encode_ids,
+    decode_ids,
+    segment_coords,
+    balanced_chunks,
+    window_codes,
+    add_window,
+    window_schemes,
+    window_frequency,
+    fix_departure_time,
+    group_codes,
+    headway_stats,
     label_creation,
-    add_frequency,
     aggregate_speed,
     add_all_lines_speed,
     add_free_flow
 )
 from itertools import permutations, chain
-from shapely import distance
 from h3 import latlng_to_cell, grid_ring
 from time import time
-import boto3
+import copy
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
 
 if not sys.warnoptions:
@@ -41,6 +56,19 @@ if not sys.warnoptions:
 
 logging.basicConfig(level=logging.INFO)
 
+# Day types accepted by `Feed.get_freq_by_day()` and their weekdays (Monday=0)
+DAY_TYPES = {
+    "weekday": [0, 1, 2, 3, 4],
+    "weekend": [5, 6],
+    "monday": [0],
+    "tuesday": [1],
+    "wednesday": [2],
+    "thursday": [3],
+    "friday": [4],
+    "saturday": [5],
+    "sunday": [6],
+}
+
 
 class Feed:
     def __init__(
@@ -52,6 +80,9 @@ class Feed:
         patterns: bool = True,
         start_date: str = None,
         end_date: str = None,
+        cache_dir: str = None,
+        cache_max_mb: int = 2048,
+        n_jobs: int = 1,
     ):
 
         self._gtfs_path = gtfs_path
@@ -61,8 +92,15 @@ class Feed:
         self._patterns = patterns
         self._start_date = start_date
         self._end_date = end_date
+        self._cache_dir = cache_dir
+        self._cache_max_mb = cache_max_mb
+        self._n_jobs = n_jobs
         self._dates = None
+        self._archive = None
+        self._ids = None
         self._routes_patterns = None
+        self._trip_segment_patterns = None
+        self._pattern_segments = None
         self._trips_patterns = None
         self._files = None
         self._bbox = None
@@ -74,15 +112,24 @@ class Feed:
         self._routes = None
         self._stops = None
         self._stop_times = None
+        self._stop_windows = {}
+        self._trip_table = None
+        self._departure_index = None
+        self._trip_intervals = None
         self._shapes = None
         self._stops_freq = None
         self._lines_freq = None
+        self._headways = None
+        self._peak_vehicles = None
         self._segments = None
         self._segments_freq = None
         self._speeds = None
         self._avg_speeds = None
         self._dist_matrix = None
         self._dates_service_id = None
+        self._service_bitmap = None
+        self._trips_per_date = None
+        self._service_intensity = None
 
     @property
     def gtfs_path(self):
@@ -92,6 +139,20 @@ class Feed:
     def time_windows(self):
         return self._time_windows
 
+    @time_windows.setter
+    def time_windows(self, value):
+        """
+        Changing the time windows only recomputes the frequency and speed
+        aggregations, the parsed GTFS and the segments are kept.
+        """
+        self._time_windows = value
+        self._stops_freq = None
+        self._lines_freq = None
+        self._headways = None
+        self._peak_vehicles = None
+        self._segments_freq = None
+        self._avg_speeds = None
+
     @property
     def busiest_date(self):
         return self._busiest_date
@@ -100,6 +161,34 @@ class Feed:
     def geo(self):
         return self._geo
 
+    @property
+    def archive(self):
+        """
+        Shared reader over the GTFS zip file. It is opened on first use
+        and kept open until `close()` is called.
+
+        Remote feeds are stored in a download cache if `cache_dir` was given.
+        """
+        if self._archive is None:
+            cache = None
+            if self._cache_dir is not None:
+                cache = DownloadCache(self._cache_dir, self._cache_max_mb)
+            self._archive = GTFSArchive(self.gtfs_path, cache=cache)
+
+        return self._archive
+
+    @property
+    def ids(self):
+        """
+        Feed-level ID dictionary: for each of trip_id, stop_id, route_id and
+        shape_id, the pd.Index of identifiers whose position is their integer
+        code in the coded tables (e.g. `stop_times`).
+        """
+        if self._ids is None:
+            self._ids = self.get_ids()
+
+        return self._ids
+
     @property
     def files(self):
         if self._files is None:
@@ -151,6 +240,28 @@ class Feed:
             self._routes_patterns = routes_patterns
         return self._trips_patterns
 
+    @property
+    def trip_segment_patterns(self):
+        """
+        Return the segment pattern followed by each trip.
+        """
+        if self._trip_segment_patterns is None:
+            (trip_segment_patterns, pattern_segments) = self.get_segment_patterns()
+            self._trip_segment_patterns = trip_segment_patterns
+            self._pattern_segments = pattern_segments
+        return self._trip_segment_patterns
+
+    @property
+    def pattern_segments(self):
+        """
+        Return the segments of each segment pattern in order.
+        """
+        if self._pattern_segments is None:
+            (trip_segment_patterns, pattern_segments) = self.get_segment_patterns()
+            self._trip_segment_patterns = trip_segment_patterns
+            self._pattern_segments = pattern_segments
+        return self._pattern_segments
+
     @property
     def busiest_service_id(self):
         """
@@ -219,6 +330,38 @@ class Feed:
 
         return self._stop_times
 
+    @property
+    def trip_table(self):
+        """
+        Compact TripTable with the stops of every trip, built once from `stop_times`.
+        """
+        if self._trip_table is None:
+            self._trip_table = TripTable.from_stop_times(self.stop_times)
+
+        return self._trip_table
+
+    @property
+    def departure_index(self):
+        """
+        DepartureIndex with the departures of every stop sorted by time,
+        built once from `trip_table`.
+        """
+        if self._departure_index is None:
+            self._departure_index = DepartureIndex.from_trip_table(self.trip_table)
+
+        return self._departure_index
+
+    @property
+    def trip_intervals(self):
+        """
+        TripIntervals with the time in service of every trip,
+        built once from `trip_table`.
+        """
+        if self._trip_intervals is None:
+            self._trip_intervals = TripIntervals.from_trip_table(self.trip_table)
+
+        return self._trip_intervals
+
     @property
     def shapes(self):
         if self._shapes is None:
@@ -240,6 +383,20 @@ class Feed:
 
         return self._lines_freq
 
+    @property
+    def headways(self):
+        if self._headways is None:
+            self._headways = self.get_headways()
+
+        return self._headways
+
+    @property
+    def peak_vehicles(self):
+        if self._peak_vehicles is None:
+            self._peak_vehicles = self.get_peak_vehicles()
+
+        return self._peak_vehicles
+
     @property
     def segments(self):
         if self._segments is None:
@@ -281,6 +438,35 @@ class Feed:
             self._dates_service_id = self.get_dates_service_id()
         return self._dates_service_id
 
+    @property
+    def service_bitmap(self):
+        """
+        Boolean DataFrame with one row per service_id and one column per
+        date of the feed, True when the service runs on that date.
+        """
+        if self._service_bitmap is None:
+            self._service_bitmap = self.get_service_bitmap()
+        return self._service_bitmap
+
+    @property
+    def trips_per_date(self):
+        """
+        Number of trips scheduled on each date of the feed.
+        """
+        if self._trips_per_date is None:
+            self._trips_per_date = self.get_trips_per_date()
+        return self._trips_per_date
+
+    @property
+    def service_intensity(self):
+        """
+        Number of trips scheduled on each date of the feed. Use
+        `get_service_intensity()` to add service hours and vehicle-km.
+        """
+        if self._service_intensity is None:
+            self._service_intensity = self.get_service_intensity()
+        return self._service_intensity
+
     @trips.setter
     def trips(self, value):
         self._trips = value
@@ -305,31 +491,34 @@ class Feed:
     def dates_service_id(self, value):
         self._dates_service_id = value
 
-    def get_files(self):
-        gtfs_path = self.gtfs_path
-
-        # S3 implementation
-        if gtfs_path.split("://")[0] == "s3":
-            s3 = boto3.resource("s3")
-            bucket = gtfs_path.split("://")[1].split("/")[0]
-            boto_bucket = s3.Bucket(bucket)
-            key = "/".join(gtfs_path.split("/")[3:])
-
-            with io.BytesIO() as data:
-                boto_bucket.download_fileobj(key, data)
-                with ZipFile(data) as myzip:
-                    return myzip.namelist()
-        else:
-            try:
-                with ZipFile(gtfs_path) as myzip:
-                    return myzip.namelist()
-            # Try as a URL if the file is not in local
-            except (FileNotFoundError, OSError) as e:
-                logging.error(e)
-                r = requests.get(self.gtfs_path)
+    def close(self):
+        """
+        Close the GTFS archive. Tables already parsed stay available.
+        """
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_ids(self):
+        """
+        Starts the ID dictionary with the stops and routes in the order of
+        stops.txt and routes.txt. Trips and shapes are added as they are read.
+        """
+        return {
+            "stop_id": pd.Index(self.stops.stop_id.unique()),
+            "route_id": pd.Index(self.routes.route_id.unique()),
+            "trip_id": pd.Index([], dtype=object),
+            "shape_id": pd.Index([], dtype=object),
+        }
 
-                with ZipFile(io.BytesIO(r.content)) as myzip:
-                    return myzip.namelist()
+    def get_files(self):
+        return self.archive.namelist()
 
     def get_bbox(self):
         logging.info("Getting the bounding box.")
@@ -382,48 +571,45 @@ class Feed:
         Compute the different patterns of each route.
         returns (trips_patterns, routes_patterns)
         """
-        stop_times = self.stop_times
+        table = self.trip_table
         logging.info("computing patterns")
-        trip_stops = stop_times[
-            [
-                "route_id",
-                "route_name",
-                "direction_id",
-                "shape_id",
-                "trip_id",
-                "stop_id",
-                "stop_sequence",
-            ]
-        ]
-        trip_stops["zipped_stops"] = list(zip(trip_stops.stop_id, trip_stops.stop_sequence))
 
-        trip_stops_zipped = trip_stops.pivot_table(
-            "zipped_stops",
-            index=["trip_id", "route_id", "route_name", "direction_id", "shape_id"],
-            aggfunc=list,
-        ).reset_index()
+        # Trips with the same sequence of (stop_id, stop_sequence) get the same code
+        sequences = table.pattern_code
+        trip_stops = pd.DataFrame({"trip_id": table.trip_ids, "sequence": sequences})
+
+        trips_with_stops = trips.merge(trip_stops)
+
+        # Build the pattern_id hash only once per pattern
+        patterns = trips_with_stops[["route_id", "direction_id", "sequence"]].drop_duplicates()
+        first_trip = pd.Series(np.arange(len(sequences))).groupby(sequences).first()
 
-        trips_with_stops = trips.merge(trip_stops_zipped)
+        def zipped_str(sequence):
+            trip = first_trip[sequence]
+            events = slice(table.offsets[trip], table.offsets[trip + 1])
+            return str(list(zip(table.stop_ids[table.stop[events]], table.stop_sequence[events].tolist())))
 
-        def version_hash(x):
-            hash = hashlib.sha1(f"{x.route_id}{x.direction_id}{str(x.zipped_stops)}".encode("UTF-8")).hexdigest()
+        zipped = {seq: zipped_str(seq) for seq in patterns.sequence.unique()}
+        patterns["zipped_stops"] = patterns.sequence.map(zipped)
+
+        def version_hash(route_id, direction_id, zipped_stops):
+            hash = hashlib.sha1(f"{route_id}{direction_id}{zipped_stops}".encode("UTF-8")).hexdigest()
             return hash[:18]
 
-        trips_with_stops["pattern_id"] = trips_with_stops.apply(version_hash, axis=1)
+        patterns["pattern_id"] = [
+            version_hash(*x) for x in zip(patterns.route_id, patterns.direction_id, patterns.zipped_stops)
+        ]
+
+        trips_with_stops = trips_with_stops.merge(patterns, how="left")
 
         # Count number of trips per pattern to identify the main one
-        route_patterns = trips_with_stops.pivot_table(
-            "trip_id",
-            index=[
-                "route_id",
-                "route_name",
-                "pattern_id",
-                "direction_id",
-                "shape_id",
-                trips_with_stops.zipped_stops.astype(str),
-            ],
-            aggfunc="count",
-        ).reset_index()
+        route_patterns = (
+            trips_with_stops.groupby(
+                ["route_id", "route_name", "pattern_id", "direction_id", "shape_id", "zipped_stops"]
+            )
+            .trip_id.count()
+            .reset_index()
+        )
 
         route_patterns = (
             route_patterns.rename({"trip_id": "cnt_trips"}, axis=1)
@@ -461,19 +647,9 @@ class Feed:
         trips_with_stops = trips_with_stops.merge(
             route_patterns[["pattern_id", "route_pattern", "pattern_name"]], how="left"
         )
-        trips_with_patterns = trips_with_stops[
-            [
-                "trip_id",
-                "route_id",
-                "pattern_id",
-                "route_pattern",
-                "pattern_name",
-                "route_name",
-                "service_id",
-                "direction_id",
-                "shape_id",
-            ]
-        ]
+        # Optional columns of trips.txt are kept at the end
+        extra_cols = [c for c in trips.columns if c not in STOP_TIMES_TRIP_COLUMNS]
+        trips_with_patterns = trips_with_stops[STOP_TIMES_TRIP_COLUMNS + extra_cols]
 
         return trips_with_patterns.copy(), route_patterns.copy()
 
@@ -481,7 +657,7 @@ class Feed:
         """
         Returns the service_id with most trips as a string.
         """
-        trips = extract_file("trips", self)
+        trips = extract_file("trips", self, schema=GTFS_SCHEMAS["trips"])
         return (
             trips.pivot_table("trip_id", index="service_id", aggfunc="count")
             .sort_values(by="trip_id", ascending=False)
@@ -501,108 +677,140 @@ class Feed:
     def get_calendar_dates(self):
         return extract_file("calendar_dates", self)
 
+    def get_service_bitmap(self):
+        service_ids, dates, bitmap = service_bitmap(self.calendar, self.calendar_dates)
+
+        return pd.DataFrame(
+            bitmap,
+            index=service_ids,
+            columns=pd.DatetimeIndex(dates, name="date"),
+        )
+
     def parse_calendar(self):
-        calendar = self.calendar
-        calendar_dates = self.calendar_dates
-        busiest_date = self.busiest_date
-
-        if calendar is not None:
-            # Parse dates
-            calendar["start_date_dt"] = calendar.start_date.astype(str).apply(pl.parse)
-            calendar["end_date_dt"] = calendar.end_date.astype(str).apply(pl.parse)
-
-            # Get all dates for a given service_id
-            calendar["all_dates"] = calendar.apply(
-                lambda x: np.array([d for d in pl.interval(x.start_date_dt, x.end_date_dt).range("days")]),
-                axis=1,
-            )
+        bitmap = self.service_bitmap
+        date_strings = bitmap.columns.strftime("%Y-%m-%d")
 
-            # Boolean variables for day types
-            cols = [
-                "monday",
-                "tuesday",
-                "wednesday",
-                "thursday",
-                "friday",
-                "saturday",
-                "sunday",
-            ]
+        # Were dates provided or we're looking for the busiest_date?
+        if not self.busiest_date:
+            self.check_service_dates()
 
-            vf = np.vectorize(bool)
-            calendar[cols] = vf(calendar[cols].values)
+        # Create dataframe with the service_id that applies to each date
+        service_index, date_index = np.nonzero(bitmap.values)
+        dates_service_id = pd.DataFrame(
+            {
+                "date": date_strings[date_index],
+                "service_id": bitmap.index[service_index],
+                "keep": True,
+            }
+        )
 
-            # Hash weekdays to make it faster
-            def get_hash_weekdays(row):
-                return {i: v for i, v in enumerate(row[cols].values[0])}
+        return dates_service_id
 
-            hash_weekdays = calendar.groupby("service_id").apply(get_hash_weekdays)
+    def check_service_dates(self):
+        """
+        Remove from `dates` the dates that don't have service in this feed.
+        """
+        bitmap = self.service_bitmap
+        dates = self.dates
+        service_dates = set(bitmap.columns[bitmap.values.any(axis=0)].strftime("%Y-%m-%d"))
 
-            # Filter dates depending on the days of the week
-            calendar["filtered_dates"] = calendar.apply(
-                lambda row: row.all_dates[[hash_weekdays[row.service_id][d.weekday()] for d in row.all_dates]],
-                axis=1,
-            )
+        # Check if the dates have service in the calendars
+        remove_dates = []
+        for i, d in enumerate(dates):
+            if d not in service_dates:
+                print(f'The date "{d}" does not have service in this feed and will be removed from the analysis.')
+                remove_dates.append(d)
 
-            # Explode filtered_dates
-            t = calendar[["service_id", "filtered_dates"]].explode("filtered_dates")
+        for d in remove_dates:
+            dates.remove(d)
 
-            # Keep the service_ids that apply to at least one date
-            t = t[t.filtered_dates.notnull()]
-            t["filtered_dates"] = t.filtered_dates.dt.date.astype(str)
+    def get_active_service_ids(self, date):
+        """
+        Returns the list of service_ids that run on a given date.
+        Input:
+            - date: string of the form "YYYY-MM-DD" or timestamp.
+        """
+        bitmap = self.service_bitmap
+        date = pd.Timestamp(date)
 
-            t = t.groupby("filtered_dates").service_id.apply(list)
+        if date not in bitmap.columns:
+            return []
 
-            # Create dictionary with dates as keys and service_id as items
-            date_hash = t.apply(lambda x: dict(zip(x, [True] * len(x)))).to_dict()
-        else:
-            date_hash = {}
-
-        if calendar_dates is not None:
-            # --- Do the same for calendar_dates ---
-            calendar_dates["date_str"] = calendar_dates.date.astype(str).apply(pl.parse).dt.date.astype(str)
-
-            cdates_hash = (
-                calendar_dates[calendar_dates.exception_type == 1]
-                .groupby("date_str")
-                .service_id.apply(list)
-                .apply(lambda x: dict(zip(x, [True] * len(x))))
-                .to_dict()
-            )
-        else:
-            cdates_hash = {}
+        return list(bitmap.index[bitmap[date].values])
 
-        # Were dates provided or we're looking for the busiest_date?
-        if busiest_date:
-            # We need to look for the busiest date.
-            # To do enable that we need to return the complete
-            # list of dates to `get_trips()`
-            # Get max date and min date
-            dates = list(date_hash.keys()) + list(cdates_hash.keys())
-        else:
-            dates = self.dates
+    def get_trips_per_date(self, trips=None):
+        """
+        Number of trips scheduled on each date of the feed.
+        """
+        return self.get_service_intensity(trips=trips).ntrips
+
+    def get_service_intensity(self, service_hours=False, vehicle_km=False, trips=None):
+        """
+        Service level on each date of the feed: number of trips and, optionally,
+        service hours and vehicle-km. The totals of each service_id are
+        multiplied by the service bitmap, so trips are never joined to dates.
+        Input:
+            - service_hours: add the hours between the first departure and the
+                last arrival of the trips.
+            - vehicle_km: add the length of the shapes of the trips.
+            - trips: all the trips of the feed. Read from trips.txt if None.
+        """
+        bitmap = self.service_bitmap
 
-            # Check if the dates have service in the calendars
-            remove_dates = []
-            for i, d in enumerate(dates):
-                if (d not in date_hash) & (d not in cdates_hash):
-                    print(f'The date "{d}" does not have service in this feed and will be removed from the analysis.')
-                    remove_dates.append(d)
+        if trips is None:
+            trips = extract_file("trips", self, schema=GTFS_SCHEMAS["trips"])
+            trips["trip_id"] = trips.trip_id.astype(str)
 
-            for d in remove_dates:
-                dates.remove(d)
+        trips = trips.reindex(columns=["trip_id", "service_id", "shape_id"]).assign(ntrips=1)
+        cols = ["ntrips"]
 
-        # Create dataframe with the service_id that applies to each date
-        aux = pd.concat([pd.DataFrame(date_hash), pd.DataFrame(cdates_hash)]).T.reset_index()
-        dates_service_id = pd.melt(aux, id_vars="index", value_vars=aux.columns)
-        dates_service_id.columns = ["date", "service_id", "keep"]
+        if service_hours:
+            trips = trips.merge(self.get_trip_durations(), how="left")
+            trips["service_hours"] = trips.duration_sec / 3600
+            cols.append("service_hours")
+
+        if vehicle_km:
+            shapes = self.shapes if self.geo else shape_lines(self.shapes)
+            shape_km = pd.DataFrame({"shape_id": shapes.shape_id, "vehicle_km": shape_lengths_km(shapes)})
+            trips = trips.merge(shape_km, how="left")
+            cols.append("vehicle_km")
+
+        service_totals = trips.groupby("service_id")[cols].sum().reindex(bitmap.index, fill_value=0)
+        intensity = bitmap.values.T.astype(np.float64) @ service_totals.values.astype(np.float64)
 
-        return dates_service_id[~dates_service_id.keep.isnull()]
+        intensity = pd.DataFrame(intensity, index=bitmap.columns, columns=cols)
+        intensity["ntrips"] = intensity.ntrips.astype(np.int64)
+
+        return intensity
+
+    def get_trip_durations(self):
+        """
+        Seconds between the first departure and the last arrival of
+        every trip in stop_times.txt.
+        """
+        schema = {c: GTFS_SCHEMAS["stop_times"][c] for c in ["trip_id", "arrival_time", "departure_time"]}
+        stop_times = extract_file("stop_times", self, schema=schema)
+
+        arrival = times_to_seconds(stop_times.arrival_time).astype(np.float64)
+        departure = times_to_seconds(stop_times.departure_time).astype(np.float64)
+        arrival[arrival == MISSING_SECONDS] = np.nan
+        departure[departure == MISSING_SECONDS] = np.nan
+
+        times = pd.DataFrame({"trip_id": stop_times.trip_id, "arrival": arrival, "departure": departure})
+        durations = times.groupby("trip_id", observed=True).agg(first=("departure", "min"), last=("arrival", "max"))
+
+        return pd.DataFrame(
+            {
+                "trip_id": durations.index.astype(str),
+                "duration_sec": (durations["last"] - durations["first"]).values,
+            }
+        )
 
     def get_trips(self):
         routes = self.routes
         dates = self.dates
 
-        trips = extract_file("trips", self)
+        trips = extract_file("trips", self, schema=GTFS_SCHEMAS["trips"], prune=False)
         trips["trip_id"] = trips.trip_id.astype(str)
         trips["route_id"] = trips.route_id.astype(str)
 
@@ -626,19 +834,21 @@ class Feed:
                 entire feed within the date range provided and we don't need to change
                 the "dates" variable at all.
             """
-            dates_service_id = self.parse_calendar()
+            bitmap = self.service_bitmap
+
+            if not self.busiest_date:
+                self.check_service_dates()
 
             # If busiest_date=True, we have to count the number of trips
             if self.busiest_date:
                 # Trip per date
-                date_ntrips = (
-                    trips.merge(dates_service_id).groupby(["date"]).trip_id.count().sort_values(ascending=False)
-                )
+                if self._trips_per_date is None:
+                    self._trips_per_date = self.get_trips_per_date(trips)
+                date_ntrips = self._trips_per_date.set_axis(self._trips_per_date.index.strftime("%Y-%m-%d"))
 
             # If we are looking for the busiest date within our date period,
             # we only keep the dates in that period of time.
             if (self.busiest_date) & (dates != []):
-                dates_service_id = dates_service_id[dates_service_id.date.isin(dates)]
                 date_ntrips = date_ntrips[date_ntrips.index.isin(dates)]
 
             # Now that we've considered both cases we can just filter
@@ -646,7 +856,7 @@ class Feed:
             if self.busiest_date:
                 # In that case, if "dates" is empty we need to find the busiest date
                 busiest_date = list(date_ntrips[date_ntrips == date_ntrips.max()].index)
-                max_trips = date_ntrips[date_ntrips == date_ntrips.max()].values[0]
+                max_trips = date_ntrips.max()
 
                 logging.info(
                     "The busiest date/s of this feed or your selected date range"
@@ -659,22 +869,15 @@ class Feed:
                 dates = busiest_date[:1]
 
             # Keep only the trips that are relevant to the use case
-            trips = (
-                trips.set_index("service_id")
-                .join(
-                    dates_service_id[dates_service_id.date.isin(dates)].set_index("service_id"),
-                    how="inner",
-                )
-                .reset_index(names="service_id")
-                .drop(["keep", "date"], axis=1)
-                .drop_duplicates()
-            )
+            active = bitmap.loc[:, bitmap.columns.isin(pd.to_datetime(dates))].values.any(axis=1)
+            trips = trips[trips.service_id.isin(bitmap.index[active])]
 
         # Get routes info in trips
         # The GTFS feed might be missing some of the keys, e.g. direction_id or shape_id.
         # To allow processing incomplete GTFS data, we must reindex instead:
         # https://pandas.pydata.org/pandas-docs/stable/user_guide/indexing.html#deprecate-loc-reindex-listlike
         # This will add NaN for any missing columns.
+        # Optional columns of the file, e.g. trip_headsign, are kept at the end.
         cols = [
             "trip_id",
             "route_id",
@@ -683,7 +886,8 @@ class Feed:
             "direction_id",
             "shape_id",
         ]
-        trips = add_route_name(trips, routes).reindex(columns=cols)
+        trips = add_route_name(trips, routes)
+        trips = trips.reindex(columns=cols + [c for c in trips.columns if c not in cols])
 
         # Fill null values
         trips["direction_id"] = trips.direction_id.fillna(0)
@@ -702,7 +906,7 @@ class Feed:
         return routes
 
     def get_stops(self):
-        stops = extract_file("stops", self)
+        stops = extract_file("stops", self, schema=GTFS_SCHEMAS["stops"], prune=False)
 
         if self.geo:
             # Add geometry to stops
@@ -719,138 +923,221 @@ class Feed:
 
     def get_stop_times(self):
         # Get trips, routes and stops info in stop_times
-        stop_times = extract_file("stop_times", self)
         if self._trips is not None:  # prevents infinite loop
             logging.info("_trips is defined in stop_times")
             trips = self._trips
         else:
             logging.info("get trips in stop_times")
             trips = self.trips
-        stops = self.stops
 
-        # Fix data types
-        stop_times["trip_id"] = stop_times.trip_id.astype(str)
-        stop_times["stop_id"] = stop_times.stop_id.astype(str)
+        # Only keep the stop_times of the selected trips while reading the file
+        stop_times = extract_file(
+            "stop_times",
+            self,
+            schema=GTFS_SCHEMAS["stop_times"],
+            filters={"trip_id": trips.trip_id},
+        )
 
-        if "route_id" in stop_times.columns:
-            stop_times["route_id"] = stop_times.route_id.astype(str)
+        # Optional trip columns are not copied to every stop
+        trips = trips[[c for c in trips.columns if c in STOP_TIMES_TRIP_COLUMNS]]
 
-        if "shape_id" in stop_times.columns:
-            stop_times["shape_id"] = stop_times.shape_id.astype(str)
+        # Identifiers are coded with the feed's ID dictionary so that every
+        # join and aggregation on stop_times works on integers
+        trips = encode_ids(trips, self.ids)
+        stop_times = encode_ids(stop_times, self.ids)
 
         # We merge stop_times to "trips" (not the other way around) because
         # "trips" have already been filtered by the busiest service_id
+        # Stop names and geometries are not copied to every row, they are
+        # added from `stops` to the outputs that need them
         stop_times = trips.merge(stop_times, how="inner")
 
-        if self.geo:
-            stop_times = stop_times.merge(stops, how="left")
-
-            # stop_times needs to be geodataframe if we want to do geometry operations
-            stop_times = gpd.GeoDataFrame(stop_times, geometry="geometry")
-
         # direction_id is optional, as it is not needed to determine route shapes
         # However, if direction_id is NaN, pivot_table will return an empty DataFrame.
         # Therefore, use a sensible default if direction id is not known.
         # Some gtfs feeds only contain direction_id 0, use that as default
         stop_times["direction_id"] = stop_times["direction_id"].fillna(0)
 
-        # Pass times to seconds since midnight
-        stop_times["arrival_time"] = [
-            seconds_since_midnight(t) if t not in [None, np.nan] else None for t in stop_times.arrival_time
-        ]
-        stop_times["departure_time"] = [
-            seconds_since_midnight(t) if t not in [None, np.nan] else None for t in stop_times.departure_time
-        ]
+        # Pass times to seconds since midnight, missing times as NaN
+        for col in ["arrival_time", "departure_time"]:
+            seconds = times_to_seconds(stop_times[col])
+            stop_times[col] = np.where(seconds == MISSING_SECONDS, np.nan, seconds)
 
         return stop_times
 
     def get_shapes(self):
         if self.geo:
-            aux = extract_file("shapes", self)
-
-            # Sort shapes by shape_pt_sequence
-            aux.sort_values(["shape_id", "shape_pt_sequence"], inplace=True)
-            shapes = (
-                aux[["shape_id", "shape_pt_lat", "shape_pt_lon"]]
-                .groupby("shape_id")
-                .agg(list)
-                .apply(lambda x: LineString(zip(x[1], x[0])), axis=1)
-            )
+            aux = extract_file("shapes", self, schema=GTFS_SCHEMAS["shapes"])
 
-            shapes = gpd.GeoDataFrame(data=shapes.index, geometry=shapes.values, crs=4326)
+            # One LineString per shape following shape_pt_sequence
+            shapes = shape_lines(aux)
             shapes["shape_id"] = shapes.shape_id.astype(str)
 
             return shapes
         else:
-            shapes = extract_file("shapes", self)
+            shapes = extract_file("shapes", self, schema=GTFS_SCHEMAS["shapes"], prune=False)
             shapes["shape_id"] = shapes.shape_id.astype(str)
             return shapes
 
-    def get_stops_freq(self):
+    def get_day_date(self, day):
+        """
+        Returns the date to analyse for a date or a day type from DAY_TYPES.
+        For day types it is the busiest date of that type within `dates`,
+        or within the whole feed if no dates were given.
+        """
+        if day.lower() not in DAY_TYPES:
+            return pd.Timestamp(day).strftime("%Y-%m-%d")
+
+        ntrips = self.trips_per_date
+        if self.dates != []:
+            ntrips = ntrips[ntrips.index.isin(pd.to_datetime(self.dates))]
+
+        ntrips = ntrips[ntrips.index.weekday.isin(DAY_TYPES[day.lower()]) & (ntrips > 0)]
+        if len(ntrips) == 0:
+            logging.info(f'There is no service on "{day}" in this feed or your selected date range.')
+            return None
+
+        return ntrips.idxmax().strftime("%Y-%m-%d")
+
+    def copy_for_dates(self, dates):
+        """
+        Returns a copy of the feed restricted to the trips of `dates`. Tables
+        that don't depend on the dates (stops, routes, shapes, calendar) and
+        the open archive are shared with this feed.
+        """
+        feed = copy.copy(self)
+        feed._busiest_date = False
+        feed._dates = list(dates)
+
+        # Trips of the new dates are added to a copy of the ID dictionary
+        if self._ids is not None:
+            feed._ids = dict(self._ids)
+        feed._reset_trip_caches()
+
+        return feed
+
+    def _reset_trip_caches(self):
+        """
+        Forget every table computed from the trips of the selected dates,
+        e.g. after a shallow copy of the feed that selects other trips.
+        """
+        self._stop_windows = {}
+        for attr in TRIP_CACHES:
+            setattr(self, attr, None)
+
+    def get_freq_by_day(self, days):
+        """
+        Stop, line and segment frequencies for several dates or day types
+        at once, e.g. ["weekday", "saturday", "sunday"] or ["2023-05-02"].
+        Day types are resolved to their busiest date (see `get_day_date`).
+
+        Trips, stop_times, patterns and segments are parsed once for all
+        the dates and only the trips are filtered for each one of them.
+
+        Returns a dictionary of the form
+        {day: {"stops_freq": ..., "lines_freq": ..., "segments_freq": ...}}.
+        segments_freq is only computed if geo=True, and without it the stop
+        and line frequencies have no geometry.
+        """
+        day_dates = {day: self.get_day_date(day) for day in days}
+        day_dates = {day: date for day, date in day_dates.items() if date is not None}
+
+        # Parse the feed once for all the dates
+        feed = self.copy_for_dates(sorted(set(day_dates.values())))
+        trips = feed.trips
+        stop_times = feed.stop_times
+        if self.geo:
+            segments = feed.segments
+
+        freqs = {}
+        for day, date in day_dates.items():
+            logging.info(f'Computing frequencies for "{day}" ({date}).')
+            day_feed = copy.copy(feed)
+            day_feed._reset_trip_caches()
+
+            service_ids = feed.get_active_service_ids(date)
+            day_trips = trips[trips.service_id.isin(service_ids)]
+            day_feed._trips = day_trips
+            day_feed._trips_patterns = day_trips if self._patterns else None
+            day_feed._stop_times = stop_times[stop_times.trip_id.isin(day_trips.trip_id)].copy()
+
+            freqs[day] = {
+                "stops_freq": day_feed.stops_freq,
+                "lines_freq": day_feed.lines_freq,
+            }
+            if self.geo:
+                # Segments are numbered for all the dates at once
+                day_feed._segments = segments
+                day_feed._trip_segment_patterns = feed._trip_segment_patterns
+                day_feed._pattern_segments = feed._pattern_segments
+                freqs[day]["segments_freq"] = day_feed.segments_freq
+
+        return freqs
+
+    def get_stop_windows(self, cutoffs=None):
+        """
+        Index of the time window of the departure at each row of `stop_times`,
+        -1 outside the windows. Computed once for each set of cutoffs and
+        shared by the stop, line and segment frequencies and the headways.
+        """
+        cutoffs = self.time_windows if cutoffs is None else cutoffs
+        key = tuple(cutoffs)
+        if key not in self._stop_windows:
+            self._stop_windows[key] = window_codes(self.stop_times.departure_time.values, cutoffs)
+
+        return self._stop_windows[key]
+
+    def get_stops_freq(self, time_windows=None):
         """
         Get the stop frequencies. For each stop of each route it
         returns the bus frequency in minutes/bus broken down by
         time window.
+
+        `time_windows` can be a list of cutoffs or a list of several of them,
+        e.g. [[0, 6, 9, 15, 19, 22, 24], list(range(25))], in which case one
+        DataFrame is returned for each. Departures are grouped only once for
+        all of them. Defaults to the `time_windows` of the Feed.
         """
-        stop_times = self.stop_times
         stops = self.stops
-        cutoffs = self.time_windows
-
-        if "window" not in stop_times.columns:
-            stop_times = window_creation(stop_times, cutoffs)
-        else:
-            stop_times["window"] = stop_times.window.astype(str)
+        schemes, several = window_schemes(time_windows, self.time_windows)
 
-        labels = label_creation(cutoffs)
-        stop_frequencies = add_frequency(stop_times, labels, index_="stop_id", col="window", cutoffs=cutoffs)
+        group, groups = group_codes(self.stop_times, ["stop_id", "direction_id"])
 
         if self.geo:
             stops_cols = ["stop_id", "stop_name", "geometry"]
         else:
             stops_cols = ["stop_id", "stop_name"]
 
-        stop_frequencies = stop_frequencies.merge(stops[stops_cols], how="left")
+        results = []
+        for cutoffs in schemes:
+            stop_frequencies = window_frequency(groups, group, self.get_stop_windows(cutoffs), cutoffs)
+            stop_frequencies = decode_ids(stop_frequencies)
+            stop_frequencies = stop_frequencies.merge(stops[stops_cols], how="left")
 
-        if self.geo:
-            stop_frequencies = gpd.GeoDataFrame(data=stop_frequencies, geometry=stop_frequencies.geometry)
+            if self.geo:
+                stop_frequencies = gpd.GeoDataFrame(data=stop_frequencies, geometry=stop_frequencies.geometry)
+
+            results.append(stop_frequencies)
 
-        return stop_frequencies
+        return results if several else results[0]
 
-    def get_lines_freq(self):
+    def get_lines_freq(self, time_windows=None):
         """
         Calculates the frequency for each pattern of a route.
         Returns the bus frequency in minutes/bus broken down by
         time window.
+
+        `time_windows` can be a list of several window schemes, as in
+        `get_stops_freq()`.
         """
 
         stop_times = self.stop_times
-        shapes = self.shapes
-        cutoffs = self.time_windows
+        schemes, several = window_schemes(time_windows, self.time_windows)
 
-        stop_times_first = stop_times.loc[stop_times.stop_sequence == 1, :]
-
-        # Create time windows
-        if "window" not in stop_times_first.columns:
-            stop_times_first = window_creation(stop_times_first, cutoffs)
-        else:
-            stop_times_first["window"] = stop_times_first.window.astype(str)
-
-        # Create labels
-        labels = label_creation(cutoffs)
-
-        # Get frequencies
-        line_frequencies = add_frequency(
-            stop_times_first,
-            labels,
-            index_=["route_id", "route_name", "shape_id"],
-            col="window",
-            cutoffs=cutoffs,
-        )
-
-        # Do we want a geodataframe?
-        if self.geo:
-            line_frequencies = pd.merge(line_frequencies, shapes, how="left")
-            line_frequencies = gpd.GeoDataFrame(data=line_frequencies, geometry=line_frequencies.geometry, crs=4326)
+        # Departures from the first stop of each trip
+        first = (stop_times.stop_sequence == 1).values
+        index_list = ["route_id", "route_name", "shape_id", "direction_id"]
+        group, groups = group_codes(stop_times.loc[first], index_list)
 
         # Clean the df
         keep_these = [
@@ -862,109 +1149,252 @@ class Feed:
             "ntrips",
             "geometry",
         ]
+        if not self.geo:
+            keep_these.remove("geometry")
+
+        results = []
+        for cutoffs in schemes:
+            line_frequencies = window_frequency(groups, group, self.get_stop_windows(cutoffs)[first], cutoffs)
+            line_frequencies = decode_ids(line_frequencies)
+
+            # Do we want a geodataframe?
+            if self.geo:
+                line_frequencies = pd.merge(line_frequencies, self.shapes, how="left")
+                line_frequencies = gpd.GeoDataFrame(
+                    data=line_frequencies, geometry=line_frequencies.geometry, crs=4326
+                )
+                line_frequencies = line_frequencies.loc[~line_frequencies.geometry.isnull()]
 
-        line_frequencies = line_frequencies.loc[~line_frequencies.geometry.isnull(), keep_these]
-
-        return line_frequencies
+            results.append(line_frequencies[keep_these])
 
-    def get_segments(self):
-        """Splits each route's shape into stop-stop LineString called segments
+        return results if several else results[0]
 
-        Returns the segment geometry as well as additional segment information
+    def get_headways(self):
+        """
+        Scheduled headways of each stop of each route and direction by time
+        window: the number of gaps between consecutive departures and their
+        mean, median, max and 90th percentile in minutes, plus their
+        coefficient of variation. Unlike min_per_trip, they show irregular
+        service. Each gap belongs to the window of the departure that ends it.
+
+        As for the windows, if the time windows are within 0 and 24 hours the
+        departures after midnight are moved to the 0-24 hour range before
+        taking the gaps, e.g. a departure at 24:30 follows the ones before
+        0:30 and not the one at 23:50.
         """
-        logging.info("Getting segments...")
         stop_times = self.stop_times
-        shapes = self.shapes
+        stops = self.stops
+        cutoffs = self.time_windows
+        labels = np.asarray(label_creation(cutoffs), dtype=object)
 
-        req_columns = ["shape_id", "stop_sequence", "stop_id", "geometry"]
-        add_columns = ["route_id", "route_name", "direction_id", "stop_name"]
+        seconds = stop_times.departure_time.values.astype(float)
+        if max(cutoffs) <= 24:
+            seconds = fix_departure_time(seconds)
 
-        # merge stop_times and shapes to calculate cut distance and interpolated point
-        df_shape_stop = (
-            stop_times[req_columns + add_columns]
-            .drop_duplicates()
-            .merge(shapes, on="shape_id", suffixes=("_stop", "_shape"))
-        )
-        logging.info("Projecting stops onto shape...")
-        df_shape_stop["cut_distance_stop_point"] = df_shape_stop[["geometry_stop", "geometry_shape"]].apply(
-            lambda x: x[1].project(x[0], normalized=True), axis=1
-        )
-        logging.info("Interpolating stops onto shape...")
-        df_shape_stop["projected_stop_point"] = df_shape_stop[["geometry_shape", "cut_distance_stop_point"]].apply(
-            lambda x: x[0].interpolate(x[1], normalized=True), axis=1
-        )
+        index_list = ["route_id", "route_name", "direction_id", "stop_id"]
+        group, groups = group_codes(stop_times, index_list)
+        stats = headway_stats(group, seconds, self.get_stop_windows(), len(cutoffs) - 1)
 
-        # calculate cut distance for
-        logging.info("Sorting shape points and stops...")
-        df_shape = shapes[shapes.shape_id.isin(stop_times.shape_id.unique())]
-        df_shape["list_of_points"] = df_shape.geometry.apply(lambda x: list(MultiPoint(x.coords).geoms))
-        df_shape_exp = df_shape.explode("list_of_points")
-        df_shape_exp["projected_line_points"] = df_shape_exp[["geometry", "list_of_points"]].apply(
-            lambda x: x[0].project(x[1], normalized=True), axis=1
-        )
+        headways = decode_ids(groups.iloc[stats.group].reset_index(drop=True))
+        headways["window"] = labels[stats.window]
+        headways["n_headways"] = stats.n_headways.values
+        for stat in ["mean", "median", "max", "p90"]:
+            headways[f"{stat}_headway_min"] = (stats[stat].values / 60).round(1)
+        headways["cv_headway"] = stats.cv.values.round(2)
 
-        # rename both dfs to concatenate
-        df_shape_stop.rename(
-            {
-                "projected_stop_point": "geometry",
-                "cut_distance_stop_point": "normalized_distance_along_shape",
-            },
-            axis=1,
-            inplace=True,
-        )
-        df_shape_stop["cut_flag"] = True
+        if self.geo:
+            stops_cols = ["stop_id", "stop_name", "geometry"]
+        else:
+            stops_cols = ["stop_id", "stop_name"]
 
-        df_shape_exp = df_shape_exp[["shape_id", "list_of_points", "projected_line_points"]]
-        df_shape_exp.rename(
-            {
-                "list_of_points": "geometry",
-                "projected_line_points": "normalized_distance_along_shape",
-            },
-            axis=1,
-            inplace=True,
+        headways = headways.merge(stops[stops_cols], how="left")
+        headways = headways.sort_values(["route_name", "direction_id", "stop_id", "window"]).reset_index(drop=True)
+
+        if self.geo:
+            headways = gpd.GeoDataFrame(data=headways, geometry=headways.geometry, crs=4326)
+
+        return headways
+
+    def get_peak_vehicles(self):
+        """
+        Peak number of vehicles in service at the same time by route and
+        time window, assuming one vehicle per trip from its first departure
+        to its last arrival. Rows with route_id "ALL_LINES" have the peak of
+        the whole system, which can be lower than the sum of the route peaks.
+        """
+        intervals = self.trip_intervals
+        routes = self.routes
+        cutoffs = self.time_windows
+        labels = np.asarray(label_creation(cutoffs), dtype=object)
+
+        peaks = intervals.peak_vehicles(cutoffs, by_route=True)
+        peaks = peaks.merge(routes[["route_id", "route_name"]], how="left")
+
+        all_lines = intervals.peak_vehicles(cutoffs)
+        all_lines["route_id"] = "ALL_LINES"
+        all_lines["route_name"] = "All lines"
+
+        peaks = pd.concat([peaks, all_lines]).sort_values(["route_name", "window"])
+        peaks["window"] = labels[peaks.window.values]
+
+        return peaks[["route_id", "route_name", "window", "peak_vehicles"]].reset_index(drop=True)
+
+    def get_segment_patterns(self):
+        """
+        Identify the unique sequences of stops that trips follow along their
+        shape, called segment patterns, and the segments between their stops.
+        Segments are numbered with a `segment_index` shared by all the patterns
+        that go through the same pair of stops of the same shape.
+        returns (trip_segment_patterns, pattern_segments)
+        """
+        stop_times = self.stop_times
+        table = self.trip_table
+        cols = ["route_id", "route_name", "direction_id", "shape_id"]
+        logging.info("computing segment patterns")
+
+        # Trips with the same sequence of (stop_id, stop_sequence) get the same code
+        offsets = table.offsets
+        trips = stop_times.iloc[table.first_rows()][cols].assign(trip_id=table.trip_ids, sequence=table.pattern_code)
+        trips = trips.reset_index(drop=True)
+
+        # Trips whose shape is not in shapes.txt, e.g. without a shape_id, have no segments
+        trips = trips[trips.shape_id.isin(self.shapes.shape_id)]
+        trips["segment_pattern"] = (
+            trips.groupby(cols + ["sequence"], sort=False, dropna=False, observed=True).ngroup().values
         )
+        trip_segment_patterns = trips[["trip_id", "segment_pattern"]].reset_index(drop=True)
 
-        df_shape_exp["cut_flag"] = False
+        # Stops of the first trip of each pattern
+        first_trips = trips.index.values[np.unique(trips.segment_pattern.values, return_index=True)[1]]
+        lengths = np.diff(offsets)[first_trips]
+        position = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        events = np.repeat(offsets[first_trips], lengths) + position
+        rows = events if table.rows is None else table.rows[events]
 
-        # combine stops and shape points
-        gdf = pd.concat([df_shape_stop, df_shape_exp], ignore_index=False)
-        gdf.sort_values(["shape_id", "normalized_distance_along_shape"], inplace=True)
-        gdf.reset_index(inplace=True, drop=True)
+        pattern_segments = stop_times.iloc[rows][cols + ["stop_sequence", "stop_id"]].reset_index(drop=True)
+        pattern_segments.insert(0, "segment_pattern", np.repeat(np.arange(len(first_trips)), lengths))
+        pattern_segments.insert(1, "position", position)
 
-        # drop all non stops (had to combine first fto get their gdf index)
-        cuts = gdf.where(gdf.cut_flag).dropna(subset="cut_flag")
-        cuts = cuts.astype({"shape_id": str, "stop_sequence": int, "direction_id": int})
-        cuts[["end_stop_id", "end_stop_name"]] = cuts.groupby("shape_id")[["stop_id", "stop_name"]].shift(-1)
+        # Each stop is the start of a segment that ends in the next stop
+        pattern_segments.rename(columns={"stop_id": "start_stop_id"}, inplace=True)
+        pattern_segments["end_stop_id"] = pattern_segments.groupby("segment_pattern").start_stop_id.shift(-1)
+        pattern_segments = pattern_segments.dropna(subset="end_stop_id").reset_index(drop=True)
 
-        # Create LineString for each stop to stop
-        segment_geometries = []
-        for shape_id in cuts.shape_id.drop_duplicates():
-            cut_idx = cuts[cuts.shape_id == shape_id].index
-            for i, cut in enumerate(cut_idx[:-1]):
-                segment_geometries.append(LineString(gdf.iloc[cut_idx[i] : cut_idx[i + 1] + 1].geometry))
+        keys = cols + ["stop_sequence", "start_stop_id", "end_stop_id"]
+        pattern_segments["segment_index"] = pattern_segments.groupby(
+            keys, sort=False, dropna=False, observed=True
+        ).ngroup()
 
-        # create into gpd adding additional columns
-        segment_df = cuts.dropna(subset="end_stop_id", axis=0)
-        logging.info(f"segments_df: {len(segment_df)}, geometry: {len(segment_geometries)}")
-        segment_gdf = gpd.GeoDataFrame(segment_df, geometry=segment_geometries)
-        # drop irrelevant columns
-        segment_gdf.drop(
+        return trip_segment_patterns, pattern_segments
+
+    def get_segments(self, n_jobs=None, executor=None):
+        """Splits each route's shape into stop-stop LineString called segments
+
+        Segments are built once for each pair of consecutive stops of the
+        segment patterns, not for every trip. Row i is the segment with
+        `segment_index` i in `pattern_segments`.
+
+        With `n_jobs` other than 1 (-1 for all cores, defaults to the one given
+        to the Feed) the shapes are split in chunks that are cut in a process
+        pool. Any `concurrent.futures` executor can be passed instead.
+
+        Returns the segment geometry as well as additional segment information
+        """
+        logging.info("Getting segments...")
+        shapes = self.shapes
+        stops = self.stops
+        pattern_segments = self.pattern_segments
+
+        segment_df = decode_ids(pattern_segments.drop_duplicates("segment_index")).drop(
+            ["segment_pattern", "position", "segment_index"], axis=1
+        )
+        segment_df.reset_index(drop=True, inplace=True)
+
+        # Points of the shapes used by the segments
+        df_shape = shapes[shapes.shape_id.isin(segment_df.shape_id.unique())].reset_index(drop=True)
+        shape_index = pd.Index(df_shape.shape_id)
+        line_coords, line_index = shapely.get_coordinates(df_shape.geometry.values, return_index=True)
+        line_offsets = np.zeros(len(df_shape) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(line_index, minlength=len(df_shape)), out=line_offsets[1:])
+
+        # Each stop is projected once onto each shape it is on
+        stop_shape = pd.concat(
             [
-                "geometry_shape",
-                "cut_flag",
-                "normalized_distance_along_shape",
-                "geometry_stop",
-            ],
-            axis=1,
-            inplace=True,
+                segment_df[["shape_id", "start_stop_id"]].set_axis(["shape_id", "stop_id"], axis=1),
+                segment_df[["shape_id", "end_stop_id"]].set_axis(["shape_id", "stop_id"], axis=1),
+            ]
+        ).drop_duplicates()
+        stop_shape["line"] = shape_index.get_indexer(stop_shape.shape_id)
+        stop_shape = stop_shape.sort_values("line", kind="stable").reset_index(drop=True)
+        stop_points = shapely.get_coordinates(stops.set_index("stop_id").geometry.reindex(stop_shape.stop_id).values)
+
+        stop_shape_index = pd.MultiIndex.from_frame(stop_shape[["shape_id", "stop_id"]])
+        segment_line = shape_index.get_indexer(segment_df.shape_id)
+        start_stop = stop_shape_index.get_indexer(pd.MultiIndex.from_frame(segment_df[["shape_id", "start_stop_id"]]))
+        end_stop = stop_shape_index.get_indexer(pd.MultiIndex.from_frame(segment_df[["shape_id", "end_stop_id"]]))
+        segment_order = np.argsort(segment_line, kind="stable")
+
+        # Split the shapes in chunks of similar size
+        n_jobs = self._n_jobs if n_jobs is None else n_jobs
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        parallel = executor is not None or n_jobs > 1
+        # A few chunks per worker keep them busy when shapes differ in size
+        n_chunks = 4 * max(n_jobs, 1 if executor is None else os.cpu_count()) if parallel else 1
+        shape_bounds = balanced_chunks(
+            np.diff(line_offsets) + np.bincount(segment_line, minlength=len(df_shape)),
+            n_chunks,
         )
-        segment_gdf.crs = "EPSG:4326"
+        stop_bounds = np.searchsorted(stop_shape.line.values, shape_bounds)
+        segment_bounds = np.searchsorted(segment_line[segment_order], shape_bounds)
+
+        chunks = []
+        for i in range(len(shape_bounds) - 1):
+            lines = slice(shape_bounds[i], shape_bounds[i + 1])
+            chunk_stops = slice(stop_bounds[i], stop_bounds[i + 1])
+            chunk_segments = segment_order[segment_bounds[i] : segment_bounds[i + 1]]
+            chunks.append(
+                (
+                    line_coords[line_offsets[lines.start] : line_offsets[lines.stop]],
+                    line_offsets[lines.start : lines.stop + 1] - line_offsets[lines.start],
+                    stop_shape.line.values[chunk_stops] - lines.start,
+                    stop_points[chunk_stops],
+                    start_stop[chunk_segments] - chunk_stops.start,
+                    end_stop[chunk_segments] - chunk_stops.start,
+                )
+            )
+
+        # Create LineString for each stop to stop with the shape points in between
+        logging.info(f"Cutting shapes into segments in {len(chunks)} chunks...")
+        if not parallel:
+            results = [segment_coords(*chunk) for chunk in chunks]
+        elif executor is not None:
+            results = list(executor.map(segment_coords, *zip(*chunks)))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                results = list(pool.map(segment_coords, *zip(*chunks)))
+
+        segment_offsets = np.concatenate([[0], np.cumsum([len(chunk[4]) for chunk in chunks])])
+        # There are no chunks if no segment has a shape
+        coords = np.concatenate([np.empty((0, 2))] + [chunk_coords for chunk_coords, _ in results])
+        indices = np.concatenate(
+            [np.empty(0, dtype=np.int64)] + [segment + start for (_, segment), start in zip(results, segment_offsets)]
+        )
+        segment_geometries = np.empty(len(segment_df), dtype=object)
+        segment_geometries[segment_order] = shapely.linestrings(coords, indices=indices)
+
+        logging.info(f"segments_df: {len(segment_df)}, geometry: {len(segment_geometries)}")
+        segment_gdf = gpd.GeoDataFrame(segment_df, geometry=segment_geometries, crs="EPSG:4326")
+        segment_gdf = segment_gdf.astype({"direction_id": int})
 
         # Add segment length in meters
-        segment_gdf["distance_m"] = segment_gdf.to_crs(code(segment_gdf)).length
+        segment_gdf["distance_m"] = line_lengths_m(segment_gdf.geometry.values)
 
         # Add segment_id and name
-        segment_gdf["segment_id"] = segment_gdf.stop_id.astype(str) + " - " + segment_gdf.end_stop_id.astype(str)
+        stop_names = stops.set_index("stop_id").stop_name
+        segment_gdf["stop_name"] = segment_gdf.start_stop_id.map(stop_names)
+        segment_gdf["end_stop_name"] = segment_gdf.end_stop_id.map(stop_names)
+        segment_gdf["segment_id"] = segment_gdf.start_stop_id.astype(str) + " - " + segment_gdf.end_stop_id.astype(str)
         segment_gdf["segment_name"] = segment_gdf.stop_name + " - " + segment_gdf.end_stop_name
 
         # Order columns
@@ -978,17 +1408,14 @@ class Feed:
             "stop_name",
             "end_stop_name",
             "segment_id",
-            "stop_id",
+            "start_stop_id",
             "end_stop_id",
             "distance_m",
             "geometry",
         ]
 
         segment_gdf = segment_gdf[col_ordered]
-        segment_gdf.rename(
-            columns=dict(stop_name="start_stop_name", stop_id="start_stop_id"),
-            inplace=True,
-        )
+        segment_gdf.rename(columns=dict(stop_name="start_stop_name"), inplace=True)
 
         return segment_gdf
 
@@ -997,7 +1424,8 @@ class Feed:
         segment_gdf = self.segments
 
         # Add runtime and distance to stop_times
-        aux = add_runtime(stop_times)
+        aux = stop_times.assign(runtime_sec=self.trip_table.to_rows(self.trip_table.runtimes()))
+        aux = add_segment_index(aux, self.trip_segment_patterns, self.pattern_segments)
         aux = add_distance(aux, segment_gdf)
 
         # Calculate the speed per segment
@@ -1031,10 +1459,12 @@ class Feed:
         """
         speeds = self.speeds
         segment_gdf = self.segments
-        cutoffs = self.time_windows
+        labels = label_creation(self.time_windows)
 
-        # Create windows for aggregation
-        speeds = window_creation(speeds, cutoffs)
+        # Speeds keep the index of the stop_times row they come from,
+        # which gives their time window
+        rows = self.stop_times.index.get_indexer(speeds.index)
+        speeds = add_window(speeds, self.get_stop_windows()[rows], labels)
 
         # Fix outliers
         speeds = fix_outliers(speeds)
@@ -1075,30 +1505,22 @@ class Feed:
 
         return data[ordered_cols]
 
-    def get_segments_freq(self):
+    def get_segments_freq(self, time_windows=None):
+        """
+        Number of trips and minutes per trip of each segment by time window,
+        per route and for all lines together.
 
-        stop_times = self.stop_times
+        `time_windows` can be a list of several window schemes, as in
+        `get_stops_freq()`.
+        """
         segment_gdf = self.segments
-        cutoffs = self.time_windows
+        schemes, several = window_schemes(time_windows, self.time_windows)
 
-        if "window" not in stop_times.columns:
-            stop_times = window_creation(stop_times, cutoffs)
-        else:
-            stop_times["window"] = stop_times.window.astype(str)
-
-        # Get labels
-        labels = label_creation(cutoffs)
-
-        # Aggregate trips
-        line_frequencies = add_frequency(
-            stop_times,
-            labels,
-            index_=["route_id", "route_name", "stop_id"],
-            col="window",
-            cutoffs=cutoffs,
-        )
+        # Aggregate trips by the segment they start at each stop
+        stop_times = add_segment_index(self.stop_times, self.trip_segment_patterns, self.pattern_segments)
+        group, groups = group_codes(stop_times, ["segment_index", "direction_id"])
 
-        keep_these = [
+        segment_cols = [
             "route_id",
             "route_name",
             "segment_name",
@@ -1111,29 +1533,6 @@ class Feed:
             "geometry",
         ]
 
-        line_frequencies = pd.merge(
-            line_frequencies,
-            segment_gdf[keep_these],
-            left_on=["route_id", "route_name", "stop_id", "direction_id"],
-            right_on=["route_id", "route_name", "start_stop_id", "direction_id"],
-            how="left",
-        )
-
-        line_frequencies.drop("stop_id", axis=1, inplace=True)
-
-        # Remove duplicates after merging
-        line_frequencies.drop_duplicates(inplace=True)
-
-        # Aggregate for all lines
-        data_complete = add_all_lines(line_frequencies, segment_gdf, labels, cutoffs)
-
-        # Do we want a geodataframe?
-        if self.geo is True:
-            data_complete = gpd.GeoDataFrame(
-                data=data_complete.drop("geometry", axis=1),
-                geometry=data_complete.geometry,
-            )
-
         # Clean data
         keep_these = [
             "route_id",
@@ -1151,9 +1550,36 @@ class Feed:
             "geometry",
         ]
 
-        data_complete = data_complete.loc[~data_complete.geometry.isnull()][keep_these]
+        results = []
+        for cutoffs in schemes:
+            labels = label_creation(cutoffs)
+            line_frequencies = window_frequency(groups, group, self.get_stop_windows(cutoffs), cutoffs)
+
+            line_frequencies = pd.merge(
+                line_frequencies.drop("direction_id", axis=1),
+                segment_gdf[segment_cols].reset_index(names="segment_index"),
+                on="segment_index",
+                how="left",
+            )
+
+            line_frequencies.drop("segment_index", axis=1, inplace=True)
+
+            # Remove duplicates after merging
+            line_frequencies.drop_duplicates(inplace=True)
 
-        return data_complete
+            # Aggregate for all lines
+            data_complete = add_all_lines(line_frequencies, segment_gdf, labels, cutoffs)
+
+            # Do we want a geodataframe?
+            if self.geo is True:
+                data_complete = gpd.GeoDataFrame(
+                    data=data_complete.drop("geometry", axis=1),
+                    geometry=data_complete.geometry,
+                )
+
+            results.append(data_complete.loc[~data_complete.geometry.isnull()][keep_these])
+
+        return results if several else results[0]
 
     def get_distance_between_stops(self):
         """
@@ -1178,18 +1604,8 @@ class Feed:
 
         stops_["hex"] = stops_.apply(lambda row: latlng_to_cell(row.stop_lat, row.stop_lon, RESOLUTION), axis=1)
 
-        # stops.head()
-
-        # Stops to utm for distance calculatin
-        utm_stops = stops_[["stop_index", "stop_id", "stop_name", "hex", "geometry"]].to_crs(code(stops_))
-
-        # # Hash for faster results
-        # stops_h3_hash = stops.set_index('stop_index').to_dict()['hex']
-        # h3_stops_hash = stops.set_index('hex').to_dict()['stop_index']
-
         # Stops in Hexbins
         h3_stops = stops_.groupby("hex").stop_index.apply(list)
-        h3_geos = utm_stops.groupby("hex").geometry.apply(list)
 
         #  Unique hex
         h3_neighbors = {hex: grid_ring(hex, k=1) for hex in stops_.hex.unique()}
@@ -1197,20 +1613,25 @@ class Feed:
         st = time()
 
         stops_comb = []
-        distances = []
 
         logging.info("Looking for stop distances")
 
         for hex, h3_group in h3_neighbors.items():
             s_index = h3_stops[h3_stops.index.isin(h3_group)].values
-            s_geos = h3_geos[h3_geos.index.isin(h3_group)].values
 
             stops_list = list(chain.from_iterable(s_index))
-            geo_list = list(chain.from_iterable(s_geos))
-            geo_perm = list(permutations(geo_list, 2))
-
             stops_comb.extend(list(permutations(stops_list, 2)))
-            distances.extend([distance(pair[0], pair[1]) for pair in geo_perm])
+
+        # Great-circle distance between every pair of neighbouring stops
+        pairs = np.array(stops_comb, dtype=np.int64).reshape(-1, 2)
+        lat = stops_.set_index("stop_index").stop_lat
+        lon = stops_.set_index("stop_index").stop_lon
+        distances = haversine_m(
+            lat.loc[pairs[:, 0]].values,
+            lon.loc[pairs[:, 0]].values,
+            lat.loc[pairs[:, 1]].values,
+            lon.loc[pairs[:, 1]].values,
+        )
 
         # Make dataframe
         dist_df = pd.DataFrame(data=stops_comb, columns=["stop_index_1", "stop_index_2"])
@@ -1234,11 +1655,98 @@ class Feed:
         return dist_df
 
 
-def extract_file(file, feed):
+# Tables computed from the trips of the selected dates
+TRIP_CACHES = [
+    "_trips",
+    "_trips_patterns",
+    "_routes_patterns",
+    "_stop_times",
+    "_trip_table",
+    "_departure_index",
+    "_trip_intervals",
+    "_stops_freq",
+    "_lines_freq",
+    "_headways",
+    "_peak_vehicles",
+    "_segments",
+    "_trip_segment_patterns",
+    "_pattern_segments",
+    "_segments_freq",
+    "_speeds",
+    "_avg_speeds",
+]
+
+# Columns of trips that are copied to stop_times
+STOP_TIMES_TRIP_COLUMNS = [
+    "trip_id",
+    "route_id",
+    "pattern_id",
+    "route_pattern",
+    "pattern_name",
+    "route_name",
+    "service_id",
+    "direction_id",
+    "shape_id",
+]
+
+# Columns used from the big tables and their data types. A dtype of None
+# lets pandas infer it. Internal reads skip the columns not listed here,
+# while the public trips, stops and shapes tables keep them.
+GTFS_SCHEMAS = {
+    "stop_times": {
+        "trip_id": "category",
+        "arrival_time": "category",
+        "departure_time": "category",
+        "stop_id": "category",
+        "stop_sequence": "int32",
+    },
+    "trips": {
+        "route_id": str,
+        "service_id": None,
+        "trip_id": str,
+        "direction_id": None,
+        "shape_id": str,
+    },
+    "shapes": {
+        "shape_id": str,
+        "shape_pt_lat": "float64",
+        "shape_pt_lon": "float64",
+        "shape_pt_sequence": "int32",
+    },
+    "stops": {
+        "stop_id": str,
+        "stop_code": str,
+        "stop_name": str,
+        "stop_lat": "float64",
+        "stop_lon": "float64",
+        "location_type": None,
+        "parent_station": str,
+    },
+}
+
+
+def extract_file(file, feed, schema=None, filters=None, prune=True):
+    """
+    Read a file of the GTFS. If a schema from `GTFS_SCHEMAS` is given its
+    columns are parsed with the data types it defines, and the other columns
+    are skipped unless `prune` is False. Public tables keep every column.
+    If `filters` is given, a dictionary of column: allowed values, the file
+    is read in chunks and the rows that don't match are discarded on the fly.
+    """
     data_types = {"shape_id": str, "stop_id": str, "route_id": str, "trip_id": str}
+    usecols = None
+
+    if schema is not None:
+        data_types = {c: dtype for c, dtype in schema.items() if dtype is not None}
+
+    if schema is not None and prune:
+        # Optional columns might be missing in the file
+        def in_schema(col):
+            return col in schema
+
+        usecols = in_schema
 
     files = feed.files
-    gtfs_path = feed.gtfs_path
 
     # check if the the zip file came from a zipped folder
     if len(files[0].split("/")) == 1:
@@ -1246,30 +1754,10 @@ def extract_file(file, feed):
     else:
         file_path = f"{files[0].split('/')[0]}/{file}.txt"
 
-    # Try as a local file
-    try:
-        if file_path in files:
-            with ZipFile(gtfs_path) as myzip:
-                logging.info(f'Reading "{file}.txt".')
-                myzip.extract(file_path, path="/tmp")
-                data = pd.read_csv(f"/tmp/{file_path}", dtype=data_types)
-
-                os.remove(f"/tmp/{file_path}")
-                return data
-        else:
-            return logging.info(f'File "{file}.txt" not found.')
-
-    # Try as a URL
-    except (FileNotFoundError, OSError) as e:
-        logging.error(e)
-        if f"{file}.txt" in files:
-            r = requests.get(gtfs_path)
-            with ZipFile(io.BytesIO(r.content)) as myzip:
-                logging.info(f'Reading "{file}.txt".')
-                myzip.extract(f"{file_path}", path="/tmp")
-                data = pd.read_csv(f"/tmp/{file_path}", dtype=data_types)
-
-                os.remove(f"/tmp/{file_path}")
-                return data
-        else:
-            return logging.info(f'File "{file}.txt" not found.')
+    if file_path in files:
+        logging.info(f'Reading "{file}.txt".')
+        if filters is not None:
+            return feed.archive.read_csv_filtered(file_path, filters, dtype=data_types, usecols=usecols)
+        return feed.archive.read_csv(file_path, dtype=data_types, usecols=usecols)
+    else:
+        return logging.info(f'File "{file}.txt" not found.')
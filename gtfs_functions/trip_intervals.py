@@ -0,0 +1,209 @@
+import numpy as np
+import pandas as pd
+
+from gtfs_functions.aux_functions import MISSING_SECONDS
+
+DAY_SECONDS = 24 * 3600
+
+
+def fold_intervals(start, end, group):
+    """
+    Cuts the intervals that go past midnight in pieces of one day and moves
+    the pieces to the 0-24 hour range, so a trip at 25:00 also counts at 1:00.
+    Input:
+        - start, end: np.arrays with the seconds since midnight of each interval.
+        - group: np.array with the group of each interval.
+    Output:
+        - start, end and group of the pieces.
+    """
+    starts, ends, groups = [], [], []
+    for day in range(int(end.max(initial=0)) // DAY_SECONDS + 1):
+        day_start = np.maximum(start, day * DAY_SECONDS)
+        day_end = np.minimum(end, (day + 1) * DAY_SECONDS)
+        keep = day_start < day_end
+        starts.append(day_start[keep] - day * DAY_SECONDS)
+        ends.append(day_end[keep] - day * DAY_SECONDS)
+        groups.append(group[keep])
+
+    return np.concatenate(starts), np.concatenate(ends), np.concatenate(groups)
+
+
+def sweep(start, end, group, times=()):
+    """
+    Number of intervals [start, end) of each group that are active after
+    every event, with a single sweep over the sorted starts and ends.
+    Input:
+        - start, end, group: np.arrays with one value per interval.
+        - times: times without an interval starting or ending at them whose
+            count is also needed, for every group with intervals.
+    Output:
+        - group, time and active intervals of each event, sorted by group
+            and time. Events at the same time are processed ends first.
+    """
+    times = np.asarray(times, dtype=np.int64)
+    groups = np.unique(group)
+    event_group = np.concatenate([group, group, np.repeat(groups, len(times))])
+    event_time = np.concatenate([start, end, np.tile(times, len(groups))]).astype(np.int64)
+    delta = np.concatenate(
+        [
+            np.ones(len(start), dtype=np.int64),
+            -np.ones(len(end), dtype=np.int64),
+            np.zeros(len(groups) * len(times), dtype=np.int64),
+        ]
+    )
+
+    order = np.lexsort((delta, event_time, event_group))
+
+    # Every group adds as many starts as ends, so the running total
+    # is back to 0 at the first event of the next group
+    return event_group[order], event_time[order], np.cumsum(delta[order])
+
+
+class TripIntervals:
+    """
+    Time in service of every trip, from its first departure to its last
+    arrival in seconds since midnight.
+
+    Trip i is in service during [start[i], end[i]). Trips and routes are
+    integer codes whose labels are in trip_ids and route_ids. Starts and ends
+    are also kept sorted on their own, so the number of trips in service at
+    any time is a difference of two binary searches.
+    """
+
+    def __init__(self, trip_ids, route_ids, trip, route, start, end):
+        self.trip_ids = pd.Index(np.asarray(trip_ids))
+        self.route_ids = pd.Index(np.asarray(route_ids))
+        self.trip = trip
+        self.route = route
+        self.start = start
+        self.end = end
+
+        self._start_order = np.argsort(start, kind="stable")
+        self._sorted_starts = start[self._start_order]
+        self._sorted_ends = np.sort(end)
+
+    @classmethod
+    def from_trip_table(cls, table):
+        departure = np.where(table.departure == MISSING_SECONDS, np.iinfo(np.int32).max, table.departure)
+        first = np.minimum.reduceat(departure, table.offsets[:-1])
+        last = np.maximum.reduceat(table.arrival, table.offsets[:-1])
+
+        # Trips without times or that end where they start have no interval
+        trip = np.flatnonzero(first < last)
+
+        return cls(
+            trip_ids=table.trip_ids,
+            route_ids=table.route_ids,
+            trip=trip.astype(np.int32),
+            route=table.route_code[trip],
+            start=first[trip].astype(np.int32),
+            end=last[trip].astype(np.int32),
+        )
+
+    def __len__(self):
+        return len(self.trip)
+
+    def n_active(self, times):
+        """
+        Number of trips in service at each time, in seconds since midnight.
+        """
+        times = np.asarray(times)
+        started = np.searchsorted(self._sorted_starts, times, side="right")
+        ended = np.searchsorted(self._sorted_ends, times, side="right")
+
+        return started - ended
+
+    def active_trips(self, start_time, end_time=None):
+        """
+        Trips in service at start_time, or at any moment of
+        [start_time, end_time) if end_time is given.
+        Input:
+            - start_time, end_time: seconds since midnight.
+        Output:
+            - DataFrame with trip_id, route_id, start_time and end_time
+                of the trips, sorted by start_time.
+        """
+        if end_time is None:
+            started = np.searchsorted(self._sorted_starts, start_time, side="right")
+        else:
+            started = np.searchsorted(self._sorted_starts, end_time, side="left")
+
+        # Only the trips that started before the end can be active
+        candidates = self._start_order[:started]
+        active = candidates[self.end[candidates] > start_time]
+
+        return pd.DataFrame(
+            {
+                "trip_id": self.trip_ids[self.trip[active]],
+                "route_id": self.route_ids[self.route[active]],
+                "start_time": self.start[active],
+                "end_time": self.end[active],
+            }
+        )
+
+    def vehicles_curve(self, by_route=False, fold=False):
+        """
+        Number of vehicles in service over the day, assuming one vehicle per
+        trip in service.
+        Input:
+            - by_route: one curve for each route instead of one for all.
+            - fold: move the times after midnight to the 0-24 hour range.
+        Output:
+            - DataFrame with time (seconds since midnight), active_vehicles
+                from that time until the next row, and route_id if by_route.
+        """
+        group, time, active = self._sweep(by_route, fold)
+
+        curve = pd.DataFrame({"time": time, "active_vehicles": active})
+        if by_route:
+            curve.insert(0, "route_id", self.route_ids[group])
+
+        return curve
+
+    def peak_vehicles(self, cutoffs, by_route=False):
+        """
+        Maximum number of vehicles in service at the same time in each
+        time window. Times after midnight are moved to the 0-24 hour
+        range if the cutoffs are within 0 and 24 hours.
+        Input:
+            - cutoffs: list of hours where the windows start and end.
+            - by_route: peak of each route instead of the whole system.
+        Output:
+            - DataFrame with window (index of the time window), peak_vehicles
+                and route_id if by_route.
+        """
+        seconds = np.asarray(cutoffs, dtype=float) * 3600
+        starts = seconds[:-1].astype(np.int64)
+        group, time, active = self._sweep(by_route, max(cutoffs) <= 24, times=starts)
+
+        window = np.searchsorted(seconds, time, side="right") - 1
+        inside = (window >= 0) & (window < len(cutoffs) - 1)
+
+        n_windows = len(cutoffs) - 1
+        key = group[inside] * n_windows + window[inside]
+        peak = pd.Series(active[inside]).groupby(key).max()
+
+        peaks = pd.DataFrame({"window": peak.index % n_windows, "peak_vehicles": peak.values})
+        if by_route:
+            peaks.insert(0, "route_id", self.route_ids[peak.index // n_windows])
+
+        return peaks
+
+    def _sweep(self, by_route, fold, times=()):
+        """
+        Group, time and trips in service from each time on, once all the
+        events at that time are applied.
+        """
+        start, end = self.start, self.end
+        group = self.route if by_route else np.zeros(len(self), dtype=np.int32)
+        if fold:
+            start, end, group = fold_intervals(start, end, group)
+
+        group, time, active = sweep(start, end, group.astype(np.int64), times)
+
+        # Keep the count after the last event at each time, the ones
+        # before are not the count at any moment
+        last = np.ones(len(time), dtype=bool)
+        last[:-1] = (group[1:] != group[:-1]) | (time[1:] != time[:-1])
+
+        return group[last], time[last], active[last]
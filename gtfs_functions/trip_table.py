@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+
+from gtfs_functions.aux_functions import MISSING_SECONDS, sequence_codes, trip_stops
+
+
+def _codes(values):
+    """
+    Integer codes and labels of a column, reusing the codes of categoricals.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.values.astype(np.int32), values.cat.categories
+
+    codes, labels = pd.factorize(values)
+    return codes.astype(np.int32), labels
+
+
+class TripTable:
+    """
+    Compact representation of the stops of every trip.
+
+    Stop events are stored trip by trip in contiguous arrays (stop codes,
+    stop_sequence, arrival and departure seconds), CSR style: the stops of
+    trip i are at positions offsets[i]:offsets[i + 1]. Trip-level attributes
+    are arrays with one value per trip: direction and route_code, shape_code
+    and service_code, whose labels are in route_ids, shape_ids and service_ids.
+    pattern_code, computed on first use, is the code of the stop pattern.
+
+    Missing times are stored as MISSING_SECONDS. `rows` maps each stop event
+    to its row in the stop_times it was built from, or is None if stop_times
+    was already sorted by trip and stop_sequence.
+    """
+
+    def __init__(
+        self,
+        trip_ids,
+        offsets,
+        stop,
+        stop_ids,
+        stop_sequence,
+        arrival,
+        departure,
+        rows=None,
+        direction=None,
+        **trip_codes,
+    ):
+        self.trip_ids = trip_ids
+        self.offsets = offsets
+        self.stop = stop
+        self.stop_ids = stop_ids
+        self.stop_sequence = stop_sequence
+        self.arrival = arrival
+        self.departure = departure
+        self.rows = rows
+        self.direction = direction
+        self._pattern_code = None
+
+        # Trip-level codes and their labels, e.g. route_code and route_ids
+        for name, (codes, labels) in trip_codes.items():
+            setattr(self, f"{name}_code", codes)
+            setattr(self, f"{name}_ids", labels)
+
+    @classmethod
+    def from_stop_times(cls, stop_times):
+        trip_index, trip_ids, order, offsets = trip_stops(stop_times)
+        rows = np.arange(len(stop_times)) if order is None else order
+
+        def seconds(col):
+            values = stop_times[col].values[rows]
+            return np.where(np.isnan(values), MISSING_SECONDS, values).astype(np.int32)
+
+        stop, stop_ids = _codes(stop_times.stop_id)
+
+        # Trip-level attributes come from the first stop of each trip
+        first = stop_times.iloc[rows[offsets[:-1]]]
+        trip_codes = {}
+        for name, col in [("route", "route_id"), ("shape", "shape_id"), ("service", "service_id")]:
+            if col in first.columns:
+                trip_codes[name] = _codes(first[col])
+
+        direction = None
+        if "direction_id" in first.columns:
+            direction = first.direction_id.fillna(0).values.astype(np.int8)
+
+        return cls(
+            trip_ids=pd.Index(trip_ids),
+            offsets=offsets,
+            stop=stop[rows],
+            stop_ids=stop_ids,
+            stop_sequence=stop_times.stop_sequence.values[rows].astype(np.int32),
+            arrival=seconds("arrival_time"),
+            departure=seconds("departure_time"),
+            rows=order,
+            direction=direction,
+            **trip_codes,
+        )
+
+    def __len__(self):
+        return len(self.stop)
+
+    @property
+    def n_trips(self):
+        return len(self.offsets) - 1
+
+    def trip_index(self):
+        """
+        Trip of each stop event.
+        """
+        return np.repeat(np.arange(self.n_trips), np.diff(self.offsets))
+
+    def positions(self):
+        """
+        Position of each stop event within its trip, starting at 0.
+        """
+        return np.arange(len(self)) - np.repeat(self.offsets[:-1], np.diff(self.offsets))
+
+    def first_rows(self):
+        """
+        Row of stop_times of the first stop of each trip.
+        """
+        first = self.offsets[:-1]
+        return first if self.rows is None else self.rows[first]
+
+    def to_rows(self, values):
+        """
+        Puts an array with one value per stop event back in the row order
+        of the stop_times the table was built from.
+        """
+        if self.rows is None:
+            return values
+
+        out = np.empty_like(values)
+        out[self.rows] = values
+        return out
+
+    def runtimes(self):
+        """
+        Seconds from the arrival at each stop to the arrival at the next stop
+        of the same trip. NaN for the last stop of each trip and for missing times.
+        """
+        arrival = np.where(self.arrival == MISSING_SECONDS, np.nan, self.arrival)
+        runtime = np.full(len(self), np.nan)
+        runtime[:-1] = np.diff(arrival)
+        runtime[self.offsets[1:][self.offsets[1:] > 0] - 1] = np.nan
+
+        return runtime
+
+    @property
+    def pattern_code(self):
+        """
+        Code of the stop pattern of each trip, see `sequences()`.
+        """
+        if self._pattern_code is None:
+            self._pattern_code = self.sequences()
+
+        return self._pattern_code
+
+    def sequences(self):
+        """
+        Integer code of the sequence of (stop, stop_sequence) of each trip.
+        Trips with the same code visit exactly the same stops.
+        """
+        zipped_stops = (self.stop.astype(np.int64) << 32) | self.stop_sequence.astype(np.int64)
+        _, codes, _, _ = sequence_codes(self.trip_index(), zipped_stops)
+
+        return codes
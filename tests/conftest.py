@@ -0,0 +1,94 @@
+import zipfile
+
+import pytest
+
+
+def gtfs_files():
+    """
+    Small feed with two routes in opposite directions along one street,
+    weekday and weekend services, and short turns every third trip.
+    """
+    files = {
+        "agency.txt": (
+            "agency_id,agency_name,agency_url,agency_timezone\n"
+            "A,Agency,http://agency.org,America/Los_Angeles\n"
+        ),
+        "routes.txt": (
+            "route_id,agency_id,route_short_name,route_long_name,route_type\n"
+            "R1,A,1,First,3\n"
+            "R2,A,2,Second,3\n"
+        ),
+        "calendar.txt": (
+            "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+            "WK,1,1,1,1,1,0,0,20240101,20240131\n"
+            "WE,0,0,0,0,0,1,1,20240101,20240131\n"
+        ),
+        "calendar_dates.txt": "service_id,date,exception_type\nWK,20240101,2\nWE,20240101,1\n",
+    }
+
+    stops = ["stop_id,stop_name,stop_lat,stop_lon"]
+    for i in range(10):
+        stops.append(f"S{i},Stop {i},{37.70 + 0.001 * i},{-122.40 + 0.001 * i}")
+    files["stops.txt"] = "\n".join(stops) + "\n"
+
+    shapes = ["shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence"]
+    for j in range(19):
+        shapes.append(f"SH1,{37.70 + 0.0005 * j},{-122.40 + 0.0005 * j},{j + 1}")
+    for j in range(19):
+        shapes.append(f"SH2,{37.709 - 0.0005 * j},{-122.391 - 0.0005 * j},{j + 1}")
+    files["shapes.txt"] = "\n".join(shapes) + "\n"
+
+    trips = ["route_id,service_id,trip_id,direction_id,shape_id,trip_headsign"]
+    stop_times = ["trip_id,arrival_time,departure_time,stop_id,stop_sequence"]
+    n = 0
+    for service, count, start, step in [("WK", 40, 5 * 3600, 1200), ("WE", 15, 6 * 3600, 3000)]:
+        for k in range(count):
+            for route, direction, shape, sequence in [
+                ("R1", 0, "SH1", list(range(10))),
+                ("R2", 1, "SH2", list(range(9, -1, -1))),
+            ]:
+                trip_id = f"T{n}"
+                n += 1
+                stops_used = sequence if k % 3 else sequence[:7]
+                trips.append(f"{route},{service},{trip_id},{direction},{shape},Headsign")
+
+                first = start + k * step + direction * 300
+                for i, stop in enumerate(stops_used):
+                    t = first + i * 120
+                    time = f"{t // 3600:02d}:{t % 3600 // 60:02d}:{t % 60:02d}"
+                    stop_times.append(f"{trip_id},{time},{time},S{stop},{i + 1}")
+
+    files["trips.txt"] = "\n".join(trips) + "\n"
+    files["stop_times.txt"] = "\n".join(stop_times) + "\n"
+
+    return files
+
+
+def write_gtfs(path, files):
+    with zipfile.ZipFile(path, "w") as z:
+        for name, content in files.items():
+            z.writestr(name, content)
+
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def gtfs_path(tmp_path_factory):
+    return write_gtfs(tmp_path_factory.mktemp("gtfs") / "gtfs.zip", gtfs_files())
+
+
+@pytest.fixture
+def make_gtfs(tmp_path):
+    """
+    Writes the test feed with extra lines appended to its files, given
+    as a dictionary of file name: lines.
+    """
+
+    def make(extra_lines):
+        files = gtfs_files()
+        for name, lines in extra_lines.items():
+            files[name] += "".join(f"{line}\n" for line in lines)
+
+        return write_gtfs(tmp_path / "gtfs.zip", files)
+
+    return make
@@ -0,0 +1,261 @@
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from shapely.ops import substring
+
+import gtfs_functions.aux_functions as aux_functions
+from gtfs_functions.aux_functions import (
+    MISSING_SECONDS,
+    balanced_chunks,
+    cut_lines,
+    decode_ids,
+    encode_ids,
+    group_codes,
+    haversine_m,
+    line_lengths_m,
+    seconds_since_midnight,
+    segment_coords,
+    sequence_codes,
+    service_bitmap,
+    times_to_seconds,
+    vertex_distances,
+    window_codes,
+    window_frequency,
+)
+
+
+def test_times_to_seconds():
+    times = ["08:00:00", "8:05:30", "23:59:59", "24:00:00", "25:10:05", "47:00:01"]
+    expected = [seconds_since_midnight(t) for t in times]
+
+    assert times_to_seconds(times).tolist() == expected
+    assert times_to_seconds(pd.Series(times, dtype="category")).tolist() == expected
+
+
+def test_times_to_seconds_whitespace():
+    assert times_to_seconds([" 08:00:00", "08:00:00 ", "\t25:00:00\t"]).tolist() == [28800, 28800, 90000]
+
+
+def test_times_to_seconds_missing_and_malformed():
+    times = ["", "   ", None, np.nan, "8am", "08:00", "08:00:00:00", "08-00-00", "-1:00:00", "aa:bb:cc"]
+    seconds = times_to_seconds(pd.Series(times, dtype=object))
+
+    assert seconds.dtype == np.int32
+    assert (seconds == MISSING_SECONDS).all()
+
+
+def test_times_to_seconds_keeps_order_with_repeated_times():
+    times = pd.Series(["10:00:00", None, "09:00:00", "10:00:00", ""] * 3)
+    expected = [36000, MISSING_SECONDS, 32400, 36000, MISSING_SECONDS] * 3
+
+    assert times_to_seconds(times).tolist() == expected
+    assert times_to_seconds(times.astype("category")).tolist() == expected
+
+
+def test_window_frequency_keeps_cutoffs_below_the_minute():
+    departures = pd.DataFrame({"stop_id": ["A", "A", "A", "B"], "direction_id": 0})
+    seconds = np.array([6 * 3600 + 10, 6 * 3600 + 20, 6 * 3600 + 59, 7 * 3600])
+    cutoffs = [0, 6 + 15 / 3600, 24]
+
+    group, groups = group_codes(departures, ["stop_id", "direction_id"])
+    freq = window_frequency(groups, group, window_codes(seconds, cutoffs), cutoffs)
+
+    assert freq.stop_id.tolist() == ["A", "A", "B"]
+    assert freq.ntrips.tolist() == [1, 2, 1]
+
+
+def test_service_bitmap_removes_exception_dates():
+    days = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+    calendar = pd.DataFrame(
+        [["WK", 1, 1, 1, 1, 1, 0, 0, 20240101, 20240107], ["WE", 0, 0, 0, 0, 0, 1, 1, 20240101, 20240107]],
+        columns=["service_id"] + days + ["start_date", "end_date"],
+    )
+    # Monday 2024-01-01 is a holiday: WK is removed and WE added
+    calendar_dates = pd.DataFrame(
+        {"service_id": ["WK", "WE"], "date": [20240101, 20240101], "exception_type": [2, 1]}
+    )
+
+    service_ids, dates, bitmap = service_bitmap(calendar, calendar_dates)
+
+    assert service_ids.tolist() == ["WK", "WE"]
+    assert dates[0] == np.datetime64("2024-01-01") and len(dates) == 7
+    assert bitmap.astype(int).tolist() == [[0, 1, 1, 1, 1, 0, 0], [1, 0, 0, 0, 0, 1, 1]]
+
+
+def tuple_groups(groups, values):
+    "Sets of groups with the same sequence of values, by tuple grouping"
+    sequences = pd.Series(values).groupby(groups, sort=False).agg(tuple)
+    return {frozenset(g) for g in sequences.index.groupby(sequences.values).values()}
+
+
+def code_groups(keys, codes):
+    return {frozenset(keys[codes == c]) for c in np.unique(codes)}
+
+
+SEQUENCES = {
+    "a": [1, 2, 3],
+    "b": [3, 2, 1],
+    "c": [1, 2, 3],
+    "d": [2, 1, 3],
+    "e": [3, 2, 1],
+    "f": [1, 2],
+    "g": [3, 3],
+    "h": [6],
+    "i": [0, 0, 6],
+    "j": [2, 1, 3],
+}
+
+
+@pytest.mark.parametrize("bases", [aux_functions.SEQUENCE_HASH_BASES, [1, 1]])
+def test_sequence_codes_match_tuple_grouping(bases, monkeypatch):
+    # With bases of 1 the fingerprints are sums, so every
+    # permutation of a sequence collides with it
+    monkeypatch.setattr(aux_functions, "SEQUENCE_HASH_BASES", bases)
+
+    # Rows of the groups interleaved, as in a stop_times file
+    rows = [(group, value, i) for group, values in SEQUENCES.items() for i, value in enumerate(values)]
+    rows = [(group, value) for group, value, _ in sorted(rows, key=lambda row: row[2])]
+    groups, values = map(np.array, zip(*rows))
+
+    keys, codes, order, offsets = sequence_codes(groups, values)
+
+    assert set(keys) == set(SEQUENCES)
+    assert code_groups(keys, codes) == tuple_groups(groups, values)
+    assert code_groups(keys, codes) == {frozenset(g) for g in ["ac", "be", "dj", "f", "g", "h", "i"]}
+    for i, key in enumerate(keys):
+        assert values[order[offsets[i] : offsets[i + 1]]].tolist() == [v for g, v in rows if g == key]
+
+
+def test_vertex_distances():
+    lines = np.array(
+        [
+            shapely.LineString([(0, 0), (3, 0), (3, 4)]),
+            # Loop back to its first point
+            shapely.LineString([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]),
+            # No length
+            shapely.LineString([(2, 2), (2, 2)]),
+        ]
+    )
+
+    coords, offsets, distances = vertex_distances(lines)
+
+    assert offsets.tolist() == [0, 3, 8, 10]
+    assert coords.tolist() == shapely.get_coordinates(lines).tolist()
+    np.testing.assert_allclose(distances, [0, 3 / 7, 1, 0, 0.25, 0.5, 0.75, 1, 0, 0])
+
+    # Same as projecting every vertex onto its line, except for the
+    # last vertex of the loop, which projects onto its start
+    line = np.repeat(np.arange(len(lines)), np.diff(offsets))
+    projected = shapely.line_locate_point(lines[line], shapely.points(coords), normalized=True)
+    np.testing.assert_allclose(np.delete(distances, 7), np.delete(projected, 7))
+
+
+def test_cut_lines_matches_substring():
+    lines = np.array(
+        [
+            shapely.LineString([(0, 0), (3, 0), (3, 4)]),
+            shapely.LineString([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]),
+        ]
+    )
+    coords, offsets, distances = vertex_distances(lines)
+
+    # Cuts at vertices, between vertices, and around the whole loop
+    line = np.array([0, 0, 0, 1, 1, 1, 1])
+    start_cut = np.array([0, 3 / 7, 0.2, 0, 0.5, 0.1, 0.25])
+    end_cut = np.array([3 / 7, 1, 0.9, 1, 1, 0.3, 0.25])
+    start_points = shapely.get_coordinates(shapely.line_interpolate_point(lines[line], start_cut, normalized=True))
+    end_points = shapely.get_coordinates(shapely.line_interpolate_point(lines[line], end_cut, normalized=True))
+
+    piece_coords, piece = cut_lines(coords, offsets, distances, line, start_cut, end_cut, start_points, end_points)
+    pieces = shapely.linestrings(piece_coords, indices=piece)
+
+    for i, (start, end) in enumerate(zip(start_cut[:-1], end_cut[:-1])):
+        expected = substring(lines[line[i]], start, end, normalized=True)
+        assert shapely.get_coordinates(pieces[i]) == pytest.approx(shapely.get_coordinates(expected))
+    # substring returns a Point for a cut without length
+    assert shapely.get_coordinates(pieces[-1]).tolist() == [[1, 0], [1, 0]]
+
+
+def test_segment_coords_cut_between_the_projected_stops():
+    lines = [shapely.LineString([(0, 0), (3, 0), (3, 4)]), shapely.LineString([(0, 0), (1, 0), (1, 1), (0, 1)])]
+    line_coords, line_index = shapely.get_coordinates(lines, return_index=True)
+    line_offsets = np.concatenate([[0], np.cumsum(np.bincount(line_index))])
+
+    # Stops next to the lines, one of them at a vertex
+    stop_line = np.array([0, 0, 0, 1, 1])
+    stop_points = np.array([[0, -0.1], [3.1, 0], [2.9, 3], [0.5, 0.1], [0.5, 1.1]])
+    start_stop, end_stop = np.array([0, 1, 3]), np.array([1, 2, 4])
+
+    coords, segment = segment_coords(line_coords, line_offsets, stop_line, stop_points, start_stop, end_stop)
+
+    assert [shapely.get_coordinates(p).tolist() for p in shapely.linestrings(coords, indices=segment)] == [
+        [[0, 0], [3, 0]],
+        [[3, 0], [3, 3]],
+        [[0.5, 0], [1, 0], [1, 1], [0.5, 1]],
+    ]
+
+
+def test_balanced_chunks():
+    assert balanced_chunks([1] * 8, 4).tolist() == [0, 2, 4, 6, 8]
+    assert balanced_chunks([1, 1, 6, 1, 1], 2).tolist() == [0, 2, 5]
+    # Never more chunks than items
+    assert balanced_chunks([3, 3], 4).tolist() == [0, 1, 2]
+    assert balanced_chunks(np.array([], dtype=np.int64), 4).tolist() == [0]
+
+
+def test_haversine_m():
+    # One degree and a quarter of a meridian on the mean Earth radius
+    degree = 6371008.8 * np.pi / 180
+    lat1, lon1 = np.array([0, 0, 45, 0]), np.array([0, 179.5, 10, 0])
+    lat2, lon2 = np.array([1, 0, 45, 90]), np.array([0, -179.5, 10, 0])
+
+    np.testing.assert_allclose(haversine_m(lat1, lon1, lat2, lon2), [degree, degree, 0, 90 * degree])
+    assert haversine_m([], [], [], []).tolist() == []
+
+
+def test_line_lengths_m():
+    degree = 6371008.8 * np.pi / 180
+    lines = [
+        # Across the border of UTM zones 31 and 32
+        shapely.LineString([(5.9, 0), (6.1, 0)]),
+        shapely.LineString([(0, 0), (0, 1), (0, 0)]),
+        shapely.LineString([(2, 2), (2, 2)]),
+    ]
+
+    np.testing.assert_allclose(line_lengths_m(lines), [0.2 * degree, 2 * degree, 0])
+    assert line_lengths_m([]).tolist() == []
+
+
+def test_encode_ids_round_trip():
+    ids = {"stop_id": pd.Index(["S1", "S2"])}
+    stop_times = pd.DataFrame(
+        {"trip_id": ["T1", "T1", None, "T2"], "stop_id": ["S2", "S9", "S1", np.nan], "n": range(4)}
+    )
+
+    coded = encode_ids(stop_times, ids)
+
+    # Unknown IDs are appended to the dictionary, nulls stay null
+    assert ids["stop_id"].tolist() == ["S1", "S2", "S9"]
+    assert ids["trip_id"].tolist() == ["T1", "T2"]
+    assert coded.stop_id.cat.codes.tolist() == [1, 2, 0, -1]
+    assert coded.trip_id.cat.codes.tolist() == [0, 0, -1, 1]
+
+    decoded = decode_ids(coded)
+    assert decoded.trip_id.tolist()[:2] + decoded.trip_id.tolist()[3:] == ["T1", "T1", "T2"]
+    assert decoded.stop_id.tolist()[:3] == ["S2", "S9", "S1"]
+    assert decoded.trip_id.isnull().tolist() == [False, False, True, False]
+    assert decoded.stop_id.isnull().tolist() == [False, False, False, True]
+    assert decoded.n.tolist() == [0, 1, 2, 3]
+
+    # Tables coded with the same dictionary share the categories
+    stops = encode_ids(pd.DataFrame({"stop_id": ["S9", "S1"]}), ids)
+    assert stops.stop_id.dtype == coded.stop_id.dtype
+    assert stops.stop_id.cat.codes.tolist() == [2, 0]
+
+
+def test_encode_ids_of_a_null_column():
+    coded = encode_ids(pd.DataFrame({"shape_id": [np.nan, np.nan]}), {})
+
+    assert coded.shape_id.cat.codes.tolist() == [-1, -1]
+    assert decode_ids(coded).shape_id.isnull().all()
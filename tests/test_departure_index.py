@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from gtfs_functions import Feed
+from gtfs_functions.aux_functions import decode_ids
+from gtfs_functions.departure_index import DepartureIndex
+
+
+@pytest.fixture(scope="module")
+def feed(gtfs_path):
+    return Feed(gtfs_path, start_date="2024-01-02", end_date="2024-01-02", busiest_date=False, geo=False)
+
+
+def brute_force(stop_times, stop_id, seconds, n):
+    departures = stop_times[(stop_times.stop_id == stop_id) & (stop_times.departure_time >= seconds)]
+    departures = departures.sort_values(["departure_time", "trip_id"]).head(n)
+
+    return departures.departure_time.astype(int).tolist()
+
+
+def test_next_departures_match_a_brute_force_filter(feed):
+    stop_times = decode_ids(feed.stop_times)
+    index = feed.departure_index
+
+    rng = np.random.default_rng(0)
+    stop_ids = rng.choice(stop_times.stop_id.unique(), 300)
+    times = rng.integers(0, 26 * 3600, 300)
+    result = index.next_departures(stop_ids, times, n=3)
+
+    for query, (stop_id, seconds) in enumerate(zip(stop_ids, times)):
+        departures = result[result["query"] == query]
+        assert (departures.stop_id == stop_id).all()
+        assert departures.departure_time.tolist() == brute_force(stop_times, stop_id, seconds, 3)
+
+        # Trips and routes are those of the departures
+        expected = stop_times.set_index(["trip_id", "stop_id"]).route_id
+        assert departures.route_id.tolist() == expected.loc[list(zip(departures.trip_id, departures.stop_id))].tolist()
+
+
+def test_next_departures_with_missing_times(feed):
+    index = feed.departure_index
+
+    for time in ["", "8am", None, -1, np.nan]:
+        assert len(index.next_departures(["S4"], [time])) == 0
+
+    result = index.next_departures(["S4", "S4", "UNKNOWN", "S4"], ["", "08:00:00", "08:00:00", -60], n=2)
+    assert result["query"].tolist() == [1, 1]
+    assert (result.departure_time >= 8 * 3600).all()
+
+
+def test_next_departures_broadcasts_stops_and_times(feed):
+    index = feed.departure_index
+
+    several_times = index.next_departures("S4", ["08:00:00", "09:00:00"], n=1)
+    assert several_times.stop_id.tolist() == ["S4", "S4"]
+    assert several_times.departure_time.tolist() == [
+        index.next_departures("S4", 8 * 3600, n=1).departure_time.iloc[0],
+        index.next_departures("S4", 9 * 3600, n=1).departure_time.iloc[0],
+    ]
+
+    several_stops = index.next_departures(["S1", "S2"], "08:00:00", n=1)
+    assert several_stops.stop_id.tolist() == ["S1", "S2"]
+
+
+def test_departure_index_round_trip(feed, tmp_path):
+    index = feed.departure_index
+    index.save(tmp_path / "departures.npz")
+    loaded = DepartureIndex.load(tmp_path / "departures.npz")
+
+    stop_ids = ["S0", "S5", "S9", "S3"]
+    times = ["05:00:00", "12:30:00", "23:00:00", "00:00:00"]
+    assert loaded.next_departures(stop_ids, times).equals(index.next_departures(stop_ids, times))
@@ -0,0 +1,252 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+import gtfs_functions.aux_functions as aux_functions
+import gtfs_functions.gtfs_functions as feed_module
+from gtfs_functions import Feed
+from gtfs_functions.aux_functions import decode_ids, label_creation, times_to_seconds, window_creation
+
+
+def sorted_frame(df):
+    cols = [c for c in df.columns if c != "geometry"]
+    return df.sort_values(cols).reset_index(drop=True)
+
+
+def test_freq_by_day_matches_a_feed_per_date(gtfs_path):
+    feed = Feed(gtfs_path, start_date="2024-01-01", end_date="2024-01-31", busiest_date=False)
+    freqs = feed.get_freq_by_day(["weekday", "saturday"])
+
+    for day, date in [("weekday", "2024-01-02"), ("saturday", "2024-01-06")]:
+        day_feed = Feed(gtfs_path, start_date=date, end_date=date, busiest_date=False)
+        for name in ["stops_freq", "lines_freq", "segments_freq"]:
+            assert_frame_equal(
+                sorted_frame(freqs[day][name]), sorted_frame(getattr(day_feed, name)), check_dtype=False
+            )
+
+    assert freqs["weekday"]["stops_freq"].ntrips.sum() > freqs["saturday"]["stops_freq"].ntrips.sum()
+
+
+def test_copy_for_dates_does_not_share_trip_caches(gtfs_path):
+    feed = Feed(gtfs_path, start_date="2024-01-02", end_date="2024-01-02", busiest_date=False)
+    feed.get_stop_windows()
+    feed.trip_table
+
+    saturday = feed.copy_for_dates(["2024-01-06"])
+
+    assert saturday._stop_windows == {}
+    assert saturday._trip_table is None
+    assert len(saturday.get_stop_windows()) == len(saturday.stop_times) < len(feed.stop_times)
+    assert len(feed.get_stop_windows()) == len(feed.stop_times)
+
+
+def test_trips_without_shape_have_no_segments(gtfs_path, make_gtfs):
+    trips = ["R1,WK,NOSHAPE,0,,Headsign", "R2,WK,UNKNOWNSHAPE,1,SH9,Headsign"]
+    stop_times = []
+    for i in range(5):
+        stop_times.append(f"NOSHAPE,07:0{i}:00,07:0{i}:00,S{i},{i + 1}")
+        stop_times.append(f"UNKNOWNSHAPE,08:0{i}:00,08:0{i}:00,S{9 - i},{i + 1}")
+    path = make_gtfs({"trips.txt": trips, "stop_times.txt": stop_times})
+
+    feed = Feed(path, start_date="2024-01-02", end_date="2024-01-02", busiest_date=False)
+    expected = Feed(gtfs_path, start_date="2024-01-02", end_date="2024-01-02", busiest_date=False)
+
+    assert_frame_equal(feed.segments, expected.segments)
+    assert set(feed.speeds.route_name) == set(expected.speeds.route_name)
+    assert len(feed.segments_freq) == len(expected.segments_freq)
+
+
+def test_window_codes_are_shared_by_the_outputs(gtfs_path, monkeypatch):
+    feed = Feed(gtfs_path, start_date="2024-01-02", end_date="2024-01-02", busiest_date=False)
+    feed.stop_times
+    feed.segments
+
+    computed = []
+    window_codes = feed_module.window_codes
+    for module in [feed_module, aux_functions]:
+        monkeypatch.setattr(module, "window_codes", lambda *args: computed.append(1) or window_codes(*args))
+
+    feed.stops_freq
+    feed.lines_freq
+    feed.segments_freq
+    feed.headways
+    feed.avg_speeds
+    assert len(computed) == 1
+
+    feed.get_stops_freq([feed.time_windows, list(range(25))])
+    assert len(computed) == 2
+
+
+def pivot_table_frequency(stop_times, index_list, cutoffs):
+    """
+    Frequencies as computed with pivot_table before they were vectorized.
+    """
+    labels = label_creation(cutoffs)
+    stop_times = window_creation(decode_ids(stop_times), cutoffs)
+    trips_agg = stop_times.pivot_table("trip_id", index=index_list + ["window"], aggfunc="count").reset_index()
+    trips_agg.rename(columns={"trip_id": "ntrips"}, inplace=True)
+
+    start_time = trips_agg.window.apply(lambda x: cutoffs[labels.index(x)])
+    end_time = trips_agg.window.apply(lambda x: cutoffs[labels.index(x) + 1])
+    trips_agg["min_per_trip"] = ((end_time - start_time) * 60 / trips_agg.ntrips).astype(int)
+
+    return trips_agg
+
+
+@pytest.mark.parametrize("cutoffs", [[0, 6, 9, 15, 19, 22, 24], list(range(25)), [5, 7.5, 8.25, 30]])
+def test_frequencies_match_pivot_table(gtfs_path, cutoffs):
+    feed = Feed(gtfs_path, start_date="2024-01-02", end_date="2024-01-02", busiest_date=False)
+    stop_times = feed.stop_times
+
+    stops_freq = feed.get_stops_freq(cutoffs)
+    expected = pivot_table_frequency(stop_times, ["stop_id", "direction_id"], cutoffs)
+    result = stops_freq[["stop_id", "direction_id", "window", "ntrips", "min_per_trip"]]
+    assert_frame_equal(sorted_frame(result), sorted_frame(expected), check_dtype=False)
+
+    lines_freq = feed.get_lines_freq(cutoffs)
+    first_stops = stop_times[stop_times.stop_sequence == 1]
+    expected = pivot_table_frequency(first_stops, ["route_id", "route_name", "direction_id"], cutoffs)
+    result = lines_freq[["route_id", "route_name", "direction_id", "window", "ntrips", "min_per_trip"]]
+    assert_frame_equal(sorted_frame(result), sorted_frame(expected), check_dtype=False)
+
+
+def test_headways_match_a_per_group_computation(make_gtfs):
+    # Late trips of R1 departing after midnight
+    trips, stop_times = [], []
+    for k, first in enumerate([23 * 3600 + 50 * 60, 24 * 3600 + 30 * 60, 25 * 3600 + 5 * 60]):
+        trips.append(f"R1,WK,LATE{k},0,SH1,Headsign")
+        for i in range(10):
+            t = first + i * 120
+            time = f"{t // 3600:02d}:{t % 3600 // 60:02d}:00"
+            stop_times.append(f"LATE{k},{time},{time},S{i},{i + 1}")
+    path = make_gtfs({"trips.txt": trips, "stop_times.txt": stop_times})
+
+    feed = Feed(path, start_date="2024-01-02", end_date="2024-01-02", busiest_date=False, geo=False)
+    cutoffs = feed.time_windows
+    labels = label_creation(cutoffs)
+    headways = feed.headways
+
+    index_list = ["route_id", "route_name", "direction_id", "stop_id"]
+    rows = []
+    for keys, departures in decode_ids(feed.stop_times).groupby(index_list):
+        seconds = np.sort(departures.departure_time.values % (24 * 3600))
+        windows = np.searchsorted(np.array(cutoffs) * 3600, seconds[1:], side="right") - 1
+        gaps = np.diff(seconds)
+        for window in np.unique(windows):
+            window_gaps = gaps[windows == window]
+            rows.append(
+                list(keys)
+                + [
+                    labels[window],
+                    len(window_gaps),
+                    round(window_gaps.mean() / 60, 1),
+                    round(np.median(window_gaps) / 60, 1),
+                    round(window_gaps.max() / 60, 1),
+                    round(np.percentile(window_gaps, 90) / 60, 1),
+                    round(window_gaps.std() / window_gaps.mean(), 2),
+                ]
+            )
+
+    stats = ["n_headways", "mean_headway_min", "median_headway_min", "max_headway_min", "p90_headway_min", "cv_headway"]
+    expected = pd.DataFrame(rows, columns=index_list + ["window"] + stats)
+    assert_frame_equal(
+        sorted_frame(headways[index_list + ["window"] + stats]), sorted_frame(expected), check_dtype=False
+    )
+
+    # Once moved to 0:30, the departure at 24:30 follows none at S0, and
+    # the next gap goes from 1:05 (25:05) to the first trip of the day at 5:00
+    night = headways[(headways.route_id == "R1") & (headways.stop_id == "S0") & (headways.window == labels[0])]
+    assert night.max_headway_min.tolist() == [235.0]
+
+
+def test_stop_times_are_parsed_from_categorical_times(gtfs_path):
+    feed = Feed(gtfs_path, start_date="2024-01-02", end_date="2024-01-02", busiest_date=False)
+    raw = feed_module.extract_file("stop_times", feed, schema=feed_module.GTFS_SCHEMAS["stop_times"])
+
+    for col in ["arrival_time", "departure_time"]:
+        assert isinstance(raw[col].dtype, pd.CategoricalDtype)
+        assert (times_to_seconds(raw[col]) == times_to_seconds(raw[col].astype(str))).all()
+
+
+def test_removed_dates_are_not_in_service(gtfs_path):
+    # The weekday service is removed on Monday 2024-01-01, a holiday
+    # that runs the weekend service instead
+    feed = Feed(gtfs_path, busiest_date=True)
+    holiday = pd.Timestamp("2024-01-01")
+
+    assert not feed.service_bitmap.loc["WK", holiday]
+    assert feed.service_bitmap.loc["WK", pd.Timestamp("2024-01-02")]
+    assert feed.get_active_service_ids(holiday) == ["WE"]
+
+    trips_per_date = feed.trips_per_date
+    assert trips_per_date[holiday] == trips_per_date[pd.Timestamp("2024-01-06")] == 30
+    assert trips_per_date[pd.Timestamp("2024-01-02")] == 80
+
+    # With both services the holiday would be the busiest date
+    assert set(feed.trips.service_id) == {"WK"}
+    assert len(feed.trips) == 80
+
+
+def test_freq_by_day_without_geometry(gtfs_path):
+    days = ["weekday", "saturday"]
+    geo_feed = Feed(gtfs_path, start_date="2024-01-01", end_date="2024-01-31", busiest_date=False)
+    feed = Feed(gtfs_path, start_date="2024-01-01", end_date="2024-01-31", busiest_date=False, geo=False)
+
+    expected = geo_feed.get_freq_by_day(days)
+    freqs = feed.get_freq_by_day(days)
+
+    for day in days:
+        assert set(freqs[day]) == {"stops_freq", "lines_freq"}
+        for name in ["stops_freq", "lines_freq"]:
+            assert "geometry" not in freqs[day][name].columns
+            assert_frame_equal(
+                sorted_frame(freqs[day][name]),
+                sorted_frame(pd.DataFrame(expected[day][name]).drop(columns="geometry")),
+                check_dtype=False,
+            )
+
+
+def test_parallel_segments_match_sequential_segments(gtfs_path):
+    feed = Feed(gtfs_path, start_date="2024-01-02", end_date="2024-01-02", busiest_date=False)
+    expected = feed.get_segments(n_jobs=1)
+
+    assert_frame_equal(feed.get_segments(n_jobs=2), expected)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert_frame_equal(feed.get_segments(executor=executor), expected)
+
+
+def test_feed_without_trip_shapes_has_no_segments(make_gtfs):
+    # The only trips of 2024-02-01 have no shape
+    trips = [f"R3,XX,NOSHAPE{k},0,,Headsign" for k in range(3)]
+    stop_times = [f"NOSHAPE{k},1{k}:0{i}:00,1{k}:0{i}:00,S{i},{i + 1}" for k in range(3) for i in range(5)]
+    path = make_gtfs(
+        {
+            "routes.txt": ["R3,A,3,Third,3"],
+            "calendar_dates.txt": ["XX,20240201,1"],
+            "trips.txt": trips,
+            "stop_times.txt": stop_times,
+        }
+    )
+
+    feed = Feed(path, start_date="2024-02-01", end_date="2024-02-01", busiest_date=False)
+
+    assert set(feed.trips.route_id) == {"R3"}
+    assert len(feed.segments) == 0
+    assert "distance_m" in feed.segments.columns
+
+
+def test_several_window_schemes_match_one_scheme_at_a_time(gtfs_path):
+    feed = Feed(gtfs_path, start_date="2024-01-02", end_date="2024-01-02", busiest_date=False)
+    schemes = [feed.time_windows, list(range(25)), [5, 7.5, 8.25, 30]]
+
+    for get_freq in [feed.get_stops_freq, feed.get_lines_freq, feed.get_segments_freq]:
+        results = get_freq(schemes)
+
+        assert len(results) == len(schemes)
+        for cutoffs, result in zip(schemes, results):
+            assert_frame_equal(result, get_freq(cutoffs))
+
+    assert_frame_equal(feed.get_stops_freq(), feed.stops_freq)
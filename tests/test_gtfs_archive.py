@@ -0,0 +1,232 @@
+import io
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from zipfile import ZipFile
+
+import pandas as pd
+import pytest
+
+from gtfs_functions.gtfs_archive import DownloadCache, GTFSArchive
+
+
+def zip_bytes(name):
+    data = io.BytesIO()
+    with ZipFile(data, "w") as z:
+        z.writestr(name, "a,b\n1,2\n")
+
+    return data.getvalue()
+
+
+class FeedServer(ThreadingHTTPServer):
+    """
+    Serves one zip archive with an ETag and counts the GET requests.
+    `get_etag` and `get_body`, if set, are sent by GET instead, as if the
+    feed changed between the HEAD and the GET requests.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FeedHandler)
+        self.etag = '"v1"'
+        self.body = zip_bytes("v1.txt")
+        self.get_etag = None
+        self.get_body = None
+        self.n_get = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/gtfs.zip"
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    def send_feed(self, etag, body, send_body):
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_feed(self.server.etag, self.server.body, send_body=False)
+
+    def do_GET(self):
+        self.server.n_get += 1
+        etag = self.server.get_etag or self.server.etag
+        body = self.server.get_body or self.server.body
+        self.send_feed(etag, body, send_body=True)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = FeedServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def write(data, version):
+    "Download function that writes data and returns its version"
+
+    def download(f):
+        f.write(data)
+        return version
+
+    return download
+
+
+def read_names(url, cache):
+    with GTFSArchive(url, cache=cache) as archive:
+        return archive.namelist()
+
+
+def test_url_is_downloaded_once_per_version(server, tmp_path):
+    cache = DownloadCache(str(tmp_path))
+
+    assert read_names(server.url, cache) == ["v1.txt"]
+    assert read_names(server.url, cache) == ["v1.txt"]
+    assert server.n_get == 1
+
+    server.etag, server.body = '"v2"', zip_bytes("v2.txt")
+    assert read_names(server.url, cache) == ["v2.txt"]
+    assert server.n_get == 2
+
+
+def test_url_is_cached_under_the_version_of_the_download(server, tmp_path):
+    cache = DownloadCache(str(tmp_path))
+
+    # The feed changes between HEAD and GET
+    server.get_etag, server.get_body = '"v2"', zip_bytes("v2.txt")
+    assert read_names(server.url, cache) == ["v2.txt"]
+    assert cache.get(server.url, '"v1"') is None
+
+    # Once HEAD reports the new version the cached copy is used
+    server.etag, server.body = '"v2"', server.get_body
+    assert read_names(server.url, cache) == ["v2.txt"]
+    assert server.n_get == 1
+
+
+def test_get_survives_eviction_by_another_process(tmp_path, monkeypatch):
+    cache = DownloadCache(str(tmp_path))
+    cache.put("url", write(b"feed", "v1")).close()
+
+    def evicted(path):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(os, "utime", evicted)
+    with cache.get("url", "v1") as f:
+        assert f.read() == b"feed"
+
+
+def test_put_survives_eviction_by_another_process(tmp_path, monkeypatch):
+    cache = DownloadCache(str(tmp_path))
+
+    def evict(keep=None):
+        os.remove(keep)
+
+    monkeypatch.setattr(cache, "evict", evict)
+    with cache.put("url", write(b"feed", "v1")) as f:
+        assert f.read() == b"feed"
+    assert cache.get("url", "v1") is None
+
+
+def test_failed_download_leaves_no_entry(tmp_path):
+    cache = DownloadCache(str(tmp_path))
+
+    def download(f):
+        f.write(b"partial")
+        raise ConnectionError()
+
+    with pytest.raises(ConnectionError):
+        cache.put("url", download)
+    assert os.listdir(tmp_path) == []
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = DownloadCache(str(tmp_path), max_size_mb=1)
+    half = b"x" * (600 * 1024)
+
+    cache.put("a", write(half, "v1")).close()
+    cache.put("b", write(half, "v1")).close()
+
+    assert cache.get("a", "v1") is None
+    with cache.get("b", "v1") as f:
+        assert f.read() == half
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+    with moto.mock_aws():
+        s3 = boto3.resource("s3")
+        bucket = s3.Bucket("feeds")
+        bucket.create()
+        bucket.Versioning().enable()
+        yield bucket
+
+
+def test_s3_is_downloaded_once_per_version(s3_bucket, tmp_path, monkeypatch):
+    cache = DownloadCache(str(tmp_path))
+    url = "s3://feeds/gtfs.zip"
+    s3_bucket.put_object(Key="gtfs.zip", Body=zip_bytes("v1.txt"))
+
+    downloads = []
+    download_s3 = GTFSArchive.download_s3
+    monkeypatch.setattr(
+        GTFSArchive, "download_s3", staticmethod(lambda *args: downloads.append(1) or download_s3(*args))
+    )
+
+    assert read_names(url, cache) == ["v1.txt"]
+    assert read_names(url, cache) == ["v1.txt"]
+    assert len(downloads) == 1
+
+    s3_bucket.put_object(Key="gtfs.zip", Body=zip_bytes("v2.txt"))
+    assert read_names(url, cache) == ["v2.txt"]
+    assert len(downloads) == 2
+
+
+def test_s3_download_is_pinned_to_the_version_read(s3_bucket):
+    s3_bucket.put_object(Key="gtfs.zip", Body=zip_bytes("v1.txt"))
+    obj = s3_bucket.Object("gtfs.zip")
+    obj.load()
+
+    # The object is replaced between the lookup and the download
+    s3_bucket.put_object(Key="gtfs.zip", Body=zip_bytes("v2.txt"))
+
+    data = io.BytesIO()
+    version = GTFSArchive.download_s3(s3_bucket, "gtfs.zip", obj.version_id, obj.e_tag, data)
+
+    assert version == obj.version_id
+    assert ZipFile(data).namelist() == ["v1.txt"]
+
+
+def test_read_csv_filtered_keeps_categories_across_chunks(tmp_path):
+    path = str(tmp_path / "gtfs.zip")
+    with ZipFile(path, "w") as z:
+        z.writestr(
+            "stop_times.txt",
+            "trip_id,stop_id,stop_sequence\nT1,S1,1\nT1,S2,2\nT2,S3,1\nT3,S4,1\nT3,S5,2\nT4,S1,1\nT3,S6,3\n",
+        )
+
+    dtype = {"trip_id": "category", "stop_id": "category", "stop_sequence": "int32"}
+    with GTFSArchive(path) as archive:
+        data = archive.read_csv_filtered("stop_times.txt", {"trip_id": ["T1", "T3"]}, chunksize=2, dtype=dtype)
+
+    assert data.columns.tolist() == ["trip_id", "stop_id", "stop_sequence"]
+    assert data.trip_id.tolist() == ["T1", "T1", "T3", "T3", "T3"]
+    assert data.stop_id.tolist() == ["S1", "S2", "S4", "S5", "S6"]
+    assert data.stop_sequence.tolist() == [1, 2, 1, 2, 3]
+    assert isinstance(data.trip_id.dtype, pd.CategoricalDtype)
+    assert isinstance(data.stop_id.dtype, pd.CategoricalDtype)
+    assert data.stop_sequence.dtype == "int32"
@@ -0,0 +1,190 @@
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from gtfs_functions import Feed
+from gtfs_functions.aux_functions import label_creation
+from gtfs_functions.trip_intervals import DAY_SECONDS, TripIntervals, fold_intervals, sweep
+
+H = 3600
+
+
+def make_intervals(rows):
+    """
+    TripIntervals from (trip_id, route_id, start hour, end hour) rows.
+    """
+    trip_ids, route_ids, start, end = zip(*rows)
+    route_code, routes = pd.factorize(pd.Series(route_ids))
+
+    return TripIntervals(
+        trip_ids=trip_ids,
+        route_ids=routes,
+        trip=np.arange(len(rows), dtype=np.int32),
+        route=route_code.astype(np.int32),
+        start=(np.array(start) * H).astype(np.int32),
+        end=(np.array(end) * H).astype(np.int32),
+    )
+
+
+def brute_force_peaks(start, end, group, cutoffs):
+    """
+    Peak of each group and window, counting the intervals in service at
+    every start and end and at the start of every window.
+    """
+    seconds = np.array(cutoffs, dtype=float) * H
+    peaks = {}
+    for g in np.unique(group):
+        mine = group == g
+        times = np.unique(np.concatenate([start[mine], end[mine], seconds[:-1]]))
+        for t in times:
+            window = np.searchsorted(seconds, t, side="right") - 1
+            if 0 <= window < len(cutoffs) - 1:
+                n = ((start[mine] <= t) & (end[mine] > t)).sum()
+                peaks[(g, window)] = max(peaks.get((g, window), 0), n)
+
+    return peaks
+
+
+# Three trips that end when a window starts, two routes that overlap
+# and trips after midnight
+ROWS = [
+    ("A1", "A", 5, 6),
+    ("A2", "A", 5, 6),
+    ("A3", "A", 5, 6),
+    ("A4", "A", 6.5, 7),
+    ("B1", "B", 5.5, 8),
+    ("B2", "B", 7, 9.5),
+    ("B3", "B", 7.5, 8.25),
+    ("B4", "B", 23.5, 25.5),
+    ("A5", "A", 24.25, 26),
+]
+
+
+def test_fold_intervals():
+    start = np.array([5, 23, 24.5, 23, 47]) * H
+    end = np.array([6, 25, 26, 49, 48]) * H
+    group = np.arange(5)
+
+    fold_start, fold_end, fold_group = fold_intervals(start, end, group)
+    pieces = sorted(zip(fold_group, fold_start / H, fold_end / H))
+
+    assert pieces == [
+        (0, 5, 6),
+        (1, 0, 1),
+        (1, 23, 24),
+        (2, 0.5, 2),
+        (3, 0, 1),
+        (3, 0, 24),
+        (3, 23, 24),
+        (4, 23, 24),
+    ]
+    assert (fold_end <= DAY_SECONDS).all()
+
+
+def test_sweep():
+    start = np.array([10, 10, 20, 5])
+    end = np.array([20, 30, 40, 15])
+    group = np.array([0, 0, 0, 1])
+
+    event_group, time, active = sweep(start, end, group, times=[12])
+
+    assert event_group.tolist() == [0, 0, 0, 0, 0, 0, 0, 1, 1, 1]
+    assert time.tolist() == [10, 10, 12, 20, 20, 30, 40, 5, 12, 15]
+    # At 20 the end is applied before the start
+    assert active.tolist() == [1, 2, 2, 1, 2, 1, 0, 1, 1, 0]
+
+
+def test_n_active_and_active_trips():
+    intervals = make_intervals(ROWS)
+
+    assert intervals.n_active(np.array([4, 5, 5.9, 6, 7.75, 9.5, 24]) * H).tolist() == [0, 3, 4, 1, 3, 0, 1]
+
+    assert set(intervals.active_trips(6 * H).trip_id) == {"B1"}
+    assert set(intervals.active_trips(8 * H).trip_id) == {"B2", "B3"}
+
+    trips = intervals.active_trips(6 * H, 7 * H)
+    assert set(trips.trip_id) == {"B1", "A4"}
+    assert trips.start_time.is_monotonic_increasing
+    assert trips.set_index("trip_id").route_id.to_dict() == {"B1": "B", "A4": "A"}
+
+
+def test_vehicles_curve():
+    intervals = make_intervals(ROWS)
+
+    curve = intervals.vehicles_curve()
+    assert curve.time.is_unique
+    assert curve.active_vehicles.tolist() == intervals.n_active(curve.time.values).tolist()
+    assert curve.set_index("time").active_vehicles.loc[6 * H] == 1
+
+    by_route = intervals.vehicles_curve(by_route=True)
+    for route, route_curve in by_route.groupby("route_id"):
+        rows = [row for row in ROWS if row[1] == route]
+        expected = make_intervals(rows).vehicles_curve()
+        assert_frame_equal(route_curve.drop(columns="route_id").reset_index(drop=True), expected)
+
+    # Folded, the trips after midnight also run at night
+    folded = intervals.vehicles_curve(fold=True).set_index("time").active_vehicles
+    assert folded.loc[0] == 1 and folded.loc[int(0.25 * H)] == 2 and folded.loc[int(1.5 * H)] == 1
+    assert folded.index.max() <= DAY_SECONDS
+
+
+def test_peak_vehicles_at_window_boundaries():
+    intervals = make_intervals([("T1", "R", 5, 6), ("T2", "R", 5, 6), ("T3", "R", 5, 6), ("T4", "R", 6.5, 7)])
+
+    peaks = intervals.peak_vehicles([0, 6, 9, 24])
+
+    assert peaks.window.tolist() == [0, 1, 2]
+    assert peaks.peak_vehicles.tolist() == [3, 1, 0]
+
+
+def test_peak_vehicles_match_a_brute_force_count():
+    intervals = make_intervals(ROWS)
+
+    for cutoffs, fold in [([0, 6, 7.75, 9, 24], True), (list(range(25)), True), ([4, 8, 12, 26], False)]:
+        start, end, group = intervals.start, intervals.end, intervals.route
+        if fold:
+            start, end, group = fold_intervals(start, end, group)
+
+        for by_route in [False, True]:
+            peaks = intervals.peak_vehicles(cutoffs, by_route=by_route)
+            groups = group if by_route else np.zeros(len(group), dtype=int)
+            expected = brute_force_peaks(start, end, groups, cutoffs)
+
+            if by_route:
+                route = intervals.route_ids.get_indexer(peaks.route_id)
+            else:
+                route = np.zeros(len(peaks), dtype=int)
+            assert dict(zip(zip(route, peaks.window), peaks.peak_vehicles)) == expected
+
+
+def test_peak_vehicles_after_midnight():
+    intervals = make_intervals(ROWS)
+
+    # Within 0 and 24 hours, B4 and A5 also run between 0:00 and 2:00
+    folded = intervals.peak_vehicles([0, 3, 24]).set_index("window").peak_vehicles
+    assert folded.tolist() == [2, 4]
+
+    # Past 24 hours they run at their own times
+    unfolded = intervals.peak_vehicles([0, 3, 24, 27]).set_index("window").peak_vehicles
+    assert unfolded.tolist() == [0, 4, 2]
+
+
+def test_feed_peak_vehicles(gtfs_path):
+    feed = Feed(gtfs_path, start_date="2024-01-02", end_date="2024-01-02", busiest_date=False, geo=False)
+    labels = label_creation(feed.time_windows)
+    peaks = feed.peak_vehicles
+
+    assert set(peaks.route_id) == {"R1", "R2", "ALL_LINES"}
+    assert set(peaks.window) <= set(labels)
+
+    # Every trip of the test feed lasts 18 or 12 minutes and they leave
+    # every 20 minutes, so one vehicle per route is enough. Windows
+    # without service have a peak of 0
+    routes = peaks[peaks.route_id != "ALL_LINES"]
+    assert routes.groupby("route_id").peak_vehicles.max().tolist() == [1, 1]
+    assert routes.peak_vehicles.min() == 0
+
+    # R2 leaves 5 minutes after R1, so both are in service together
+    all_lines = peaks[peaks.route_id == "ALL_LINES"]
+    assert all_lines.peak_vehicles.max() == 2
+    assert all_lines.route_name.eq("All lines").all()
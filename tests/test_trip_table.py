@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+
+from gtfs_functions import Feed
+from gtfs_functions.aux_functions import MISSING_SECONDS
+from gtfs_functions.trip_table import TripTable
+
+
+def stop_times_frame():
+    """
+    Three trips with their rows shuffled: T1 and T3 visit the same stops,
+    T2 has a missing time and runs in the other direction.
+    """
+    rows = [
+        ("T2", 2, "C", 700, 710, "R2", 1),
+        ("T1", 1, "A", 100, 100, "R1", 0),
+        ("T3", 1, "A", 400, 400, "R1", 0),
+        ("T1", 3, "C", 300, 300, "R1", 0),
+        ("T2", 1, "D", 600, 600, "R2", 1),
+        ("T3", 2, "B", 450, 460, "R1", 0),
+        ("T1", 2, "B", 200, 210, "R1", 0),
+        ("T2", 3, "A", np.nan, np.nan, "R2", 1),
+        ("T3", 3, "C", 500, 500, "R1", 0),
+    ]
+    columns = ["trip_id", "stop_sequence", "stop_id", "arrival_time", "departure_time", "route_id", "direction_id"]
+
+    return pd.DataFrame(rows, columns=columns)
+
+
+def test_from_stop_times():
+    stop_times = stop_times_frame()
+    table = TripTable.from_stop_times(stop_times)
+
+    assert table.trip_ids.tolist() == ["T2", "T1", "T3"]
+    assert table.n_trips == 3 and len(table) == 9
+    assert table.offsets.tolist() == [0, 3, 6, 9]
+    assert table.stop_ids[table.stop].tolist() == ["D", "C", "A", "A", "B", "C", "A", "B", "C"]
+    assert table.stop_sequence.tolist() == [1, 2, 3] * 3
+    assert table.arrival.tolist() == [600, 700, MISSING_SECONDS, 100, 200, 300, 400, 450, 500]
+    assert table.departure.tolist() == [600, 710, MISSING_SECONDS, 100, 210, 300, 400, 460, 500]
+    assert table.route_ids[table.route_code].tolist() == ["R2", "R1", "R1"]
+    assert table.direction.tolist() == [1, 0, 0]
+
+    # Rows of stop_times of each stop event
+    assert stop_times.trip_id.values[table.rows].tolist() == np.repeat(table.trip_ids, 3).tolist()
+    assert table.trip_index().tolist() == [0, 0, 0, 1, 1, 1, 2, 2, 2]
+    assert table.positions().tolist() == [0, 1, 2] * 3
+
+
+def test_sorted_stop_times_keep_their_rows():
+    stop_times = stop_times_frame().sort_values(["trip_id", "stop_sequence"]).reset_index(drop=True)
+    table = TripTable.from_stop_times(stop_times)
+
+    assert table.rows is None
+    assert table.first_rows().tolist() == [0, 3, 6]
+    values = np.arange(9)
+    assert table.to_rows(values) is values
+
+
+def test_first_rows_and_to_rows():
+    stop_times = stop_times_frame()
+    table = TripTable.from_stop_times(stop_times)
+
+    first = stop_times.iloc[table.first_rows()]
+    assert first.trip_id.tolist() == ["T2", "T1", "T3"]
+    assert first.stop_sequence.tolist() == [1, 1, 1]
+
+    # Values of the stop events go back to the rows they came from
+    stop_sequence = table.to_rows(table.stop_sequence)
+    assert stop_sequence.tolist() == stop_times.stop_sequence.tolist()
+    stops = table.to_rows(table.stop_ids[table.stop].values)
+    assert stops.tolist() == stop_times.stop_id.tolist()
+
+
+def test_runtimes():
+    stop_times = stop_times_frame()
+    table = TripTable.from_stop_times(stop_times)
+
+    runtimes = table.runtimes()
+    np.testing.assert_array_equal(runtimes, [100, np.nan, np.nan, 100, 100, np.nan, 50, 50, np.nan])
+
+    # Same as a groupby on the stop_times ordered by trip and stop_sequence
+    ordered = stop_times.sort_values(["trip_id", "stop_sequence"])
+    expected = ordered.groupby("trip_id").arrival_time.shift(-1) - ordered.arrival_time
+    np.testing.assert_array_equal(table.to_rows(runtimes), expected.sort_index().values)
+
+
+def test_pattern_code():
+    table = TripTable.from_stop_times(stop_times_frame())
+
+    code = table.pattern_code
+    assert code[1] == code[2] != code[0]
+    assert table.pattern_code is code
+
+
+def test_trip_table_of_a_feed(gtfs_path):
+    feed = Feed(gtfs_path, start_date="2024-01-02", end_date="2024-01-02", busiest_date=False, geo=False)
+    stop_times = feed.stop_times
+    table = feed.trip_table
+
+    assert table.n_trips == stop_times.trip_id.nunique()
+    assert len(table) == len(stop_times)
+
+    # Trips get the same pattern code if and only if they visit the same stops
+    sequences = pd.Series(table.stop).groupby(table.trip_index()).agg(tuple).values
+    assert pd.Series(sequences).groupby(table.pattern_code).nunique().eq(1).all()
+    assert len(set(table.pattern_code)) == len(set(sequences))